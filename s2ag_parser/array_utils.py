@@ -0,0 +1,57 @@
+import os
+import shutil
+
+import numpy as np
+
+from s2ag_parser.io_utils import COPY_BUFFER_BYTES
+
+class NpyAppender:
+    # appends to a 1d .npy file whose final length is not known upfront. values go to a raw side file, and the
+    # .npy header is written in front of them on close, so the result can be opened with np.load(mmap_mode="r")
+    def __init__(self, path: str, dtype: np.dtype | str):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.raw_path = f"{path}.raw"
+        self.f_raw = open(self.raw_path, "wb")
+        self.length = 0
+
+    def append(self, values: np.ndarray | list):
+        values = np.asarray(values, dtype=self.dtype)
+        values.tofile(self.f_raw)
+        self.length += len(values)
+
+    def close(self):
+        self.f_raw.close()
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.length,)}
+        with open(self.path, "wb") as f_out, open(self.raw_path, "rb") as f_raw:
+            np.lib.format.write_array_header_1_0(f_out, header)
+            shutil.copyfileobj(f_raw, f_out, COPY_BUFFER_BYTES)
+        os.remove(self.raw_path)
+
+    def abort(self):
+        # drop what was appended without writing the .npy file, so that a failed run leaves nothing loadable
+        self.f_raw.close()
+        os.remove(self.raw_path)
+
+    def __enter__(self) -> "NpyAppender":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class IndptrAppender(NpyAppender):
+    # offsets of consecutive variable-length rows (as in CSR matrices): row i spans [indptr[i], indptr[i+1]).
+    # rows are appended by their lengths
+    def __init__(self, path: str):
+        super().__init__(path, np.int64)
+        self.total = 0
+        self.append([0])
+
+    def append_lengths(self, lengths: np.ndarray | list):
+        offsets = self.total + np.cumsum(lengths, dtype=np.int64)
+        self.append(offsets)
+        if len(offsets):
+            self.total = int(offsets[-1])
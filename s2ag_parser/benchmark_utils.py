@@ -0,0 +1,28 @@
+import time
+
+from s2ag_parser.profile_utils import PaperProfile
+from s2ag_parser.s2orc_utils import build_s2orc_record
+
+def time_stages(raw_s2orcs: list[dict], repeats: int = 1) -> dict[str, float]:
+    # total seconds per stage of build_s2orc_record over all papers. the fastest repeat of each stage is kept, which
+    # is the least disturbed by other processes
+    best = None
+    for _ in range(repeats):
+        stage2seconds = {}
+        for raw_s2orc in raw_s2orcs:
+            profile = PaperProfile()
+            build_s2orc_record(raw_s2orc, profile)
+            for stage, seconds in profile.stage2seconds.items():
+                stage2seconds[stage] = stage2seconds.get(stage, 0.) + seconds
+        best = stage2seconds if best is None else {stage: min(best[stage], stage2seconds[stage]) for stage in best}
+    return best
+
+def time_fn(fn, inputs: list, repeats: int = 1) -> float:
+    # seconds of the fastest of repeats runs of fn over all inputs
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for x in inputs:
+            fn(x)
+        best = min(best, time.perf_counter() - start)
+    return best
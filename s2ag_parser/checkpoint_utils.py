@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+from typing import Callable
+
+from s2ag_parser.io_utils import COPY_BUFFER_BYTES, atomic_output, merge_parts, read_manifest, write_manifest
+
+SAMPLE_HASH_BYTES = 1 << 20
+
+def get_fingerprint(filepath: str, full_hash: bool = False) -> dict:
+    # size and mtime catch almost every change to a file. the hash covers the whole file only if full_hash is set,
+    # and otherwise only its first and last SAMPLE_HASH_BYTES, which is cheap even for very large shards
+    stat = os.stat(filepath)
+    full_hash = full_hash or stat.st_size <= 2 * SAMPLE_HASH_BYTES
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        if full_hash:
+            while chunk := f.read(COPY_BUFFER_BYTES):
+                sha256.update(chunk)
+        else:
+            sha256.update(f.read(SAMPLE_HASH_BYTES))
+            f.seek(-SAMPLE_HASH_BYTES, os.SEEK_END)
+            sha256.update(f.read(SAMPLE_HASH_BYTES))
+
+    return {
+        "path": filepath,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": sha256.hexdigest(),
+        "hash": "full" if full_hash else "sample",
+    }
+
+def get_checkpoint_dir(out_path: str) -> str:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.checkpoints
+    root, _ = os.path.splitext(out_path)
+    return f"{root}.checkpoints"
+
+class CheckpointStore:
+    # one json completion record per unit of work (an input shard, or a build step), each written atomically.
+    # a unit is done if its record exists, its inputs still have the recorded fingerprints, and its outputs exist
+    def __init__(self, checkpoint_dir: str):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_dir = checkpoint_dir
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{key}.json")
+
+    def load(self, key: str) -> dict | None:
+        try:
+            with open(self.get_path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, record: dict):
+        with atomic_output(self.get_path(key)) as tmp_path, open(tmp_path, "w") as f:
+            json.dump(record, f, indent=2)
+
+    def remove(self, key: str):
+        if os.path.exists(self.get_path(key)):
+            os.remove(self.get_path(key))
+
+    def is_done(self, key: str, inputs: list[dict]) -> bool:
+        record = self.load(key)
+        return (
+            record is not None
+            and record["inputs"] == inputs
+            and all(os.path.exists(path) for path in record["outputs"])
+        )
+
+    def run_step(self, key: str, input_paths: list[str], output_paths: list[str], fn: Callable[[], None]):
+        # run fn unless a previous run already produced output_paths from the same inputs
+        inputs = [get_fingerprint(path) for path in input_paths]
+        if self.is_done(key, inputs):
+            print(f"Skipping {key}, already built from the same inputs")
+            return
+        self.remove(key)
+        fn()
+        self.save(key, {"inputs": inputs, "outputs": output_paths})
+
+## Per-shard records. a shard (an input file) is written to its own parts, and gets a record once all of them are
+## written; the parts of all shards are listed in a manifest (see io_utils.write_manifest), and may be merged
+
+def remove_shard_record(store: CheckpointStore, shard: str):
+    # parts of a stale record are named like the ones about to be written, but there may be more of them.
+    # slices of a merged file are left alone, as they are replaced when the file is merged again
+    record = store.load(shard)
+    if record is not None:
+        for part in record["parts"]:
+            if "offset" not in part and os.path.exists(part["path"]):
+                os.remove(part["path"])
+        store.remove(shard)
+
+def is_merged(records: list[dict], out_path: str) -> bool:
+    # whether out_path already is the merge of the parts of records, in order: every part is a slice of it, right
+    # after the previous one, and out_path has not changed since it was merged
+    if not os.path.exists(out_path):
+        return False
+    merged = get_fingerprint(out_path)
+    offset = 0
+    for record in records:
+        if record.get("merged") != merged:
+            return False
+        for part in record["parts"]:
+            if part["path"] != out_path or part.get("offset") != offset:
+                return False
+            offset += part["num_bytes"]
+    return offset == merged["size"]
+
+def get_shard_record(fingerprint: dict, parts: list[dict], merged: dict | None = None) -> dict:
+    # once parts are merged, they are slices of the merged file, whose fingerprint is kept as merged
+    record = {
+        "inputs": [fingerprint], 
+        "outputs": sorted(set(part["path"] for part in parts)), 
+        "parts": parts, 
+        "num_lines": sum(part["num_lines"] for part in parts), 
+        "num_papers": sum(part["num_papers"] for part in parts),
+    }
+    return record if merged is None else record | {"merged": merged}
+
+def is_shard_done(
+        store: CheckpointStore, 
+        shard: str, 
+        fingerprint: dict, 
+        units: list[tuple[str, int, int]], 
+        merged_fingerprints: dict,
+    ) -> bool:
+    # a shard is only done if its parts are the (filepath, start, end) units currently assigned to this partition:
+    # units move between partitions when the inputs change, or split differently when --range-size does. a shard
+    # whose parts were merged is also only done if the merged file is still the one its slices point into.
+    # merged_fingerprints caches the current fingerprints of merged files
+    if not store.is_done(shard, [fingerprint]):
+        return False
+    record = store.load(shard)
+    if [(part["filepath"], part["start"], part["end"]) for part in record["parts"]] != units:
+        return False
+    merged = record.get("merged")
+    if merged is None:
+        return True
+    if merged["path"] not in merged_fingerprints:
+        merged_fingerprints[merged["path"]] = get_fingerprint(merged["path"])
+    return merged == merged_fingerprints[merged["path"]]
+
+def merge_and_release_parts(manifest_path: str, out_path: str, partitions: list[tuple[CheckpointStore, str]]):
+    # merge the parts listed in a manifest into out_path, then point the shard records and manifests of every
+    # partition (a checkpoint store and its manifest) at slices of out_path, and only then remove the part files,
+    # so that reruns can still skip finished shards without keeping a second copy of the output.
+    # if the process dies halfway, records are either still pointing at the old files, which are not removed yet, or
+    # at slices of out_path, or at an older merged file whose fingerprint no longer matches, so they are redone
+    parts = read_manifest(manifest_path)
+    merged_parts = merge_parts(manifest_path, out_path)
+    write_manifest(manifest_path, merged_parts)
+    merged = get_fingerprint(out_path)
+
+    part2merged = {(part["filepath"], part["start"]): merged_part for part, merged_part in zip(parts, merged_parts)}
+    for store, partition_manifest_path in partitions:
+        partition_parts = read_manifest(partition_manifest_path)
+        for shard in dict.fromkeys(os.path.basename(part["filepath"]) for part in partition_parts):
+            record = store.load(shard)
+            shard_parts = [part2merged[(part["filepath"], part["start"])] for part in record["parts"]]
+            store.save(shard, get_shard_record(record["inputs"][0], shard_parts, merged))
+        write_manifest(
+            partition_manifest_path, 
+            [part2merged[(part["filepath"], part["start"])] for part in partition_parts],
+        )
+
+    # other merged files may still be pointed at by records that are not in this manifest, so only part files are
+    # removed here
+    for path in set(part["path"] for part in parts if "offset" not in part) - {out_path}:
+        os.remove(path)
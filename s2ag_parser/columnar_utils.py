@@ -0,0 +1,142 @@
+import json
+import os
+
+import numpy as np
+
+from s2ag_parser.array_utils import IndptrAppender, NpyAppender
+from s2ag_parser.datautils import get_paragraphs_flat
+from s2ag_parser.schemas import allowed_reference_marker_types
+
+MISSING = -1    # stands in for None in integer columns
+META_FILENAME = "columns.json"
+
+# one row per paper, paragraph (in document order) or reference marker, plus the values of variable-length fields.
+# spans are original spans; marker_type indexes into allowed_reference_marker_types; marker_referenced_id holds the
+# bibliography id of bibrefs, while the content id referenced by figurerefs and tablerefs is in
+# marker_referenced_content_id
+DATA_COLUMNS = {
+    "paper_corpusid": np.int64,
+    "paragraph_content_id": np.int64,
+    "paragraph_start": np.int64,
+    "paragraph_end": np.int64,
+    "paragraph_text": np.uint8,     # utf-8 bytes of all paragraph texts, concatenated
+    "marker_type": np.int8,
+    "marker_start": np.int64,
+    "marker_end": np.int64,
+    "marker_referenced_id": np.int64,
+    "marker_referenced_content_id": np.int64,
+}
+# offsets of each row's values: e.g. the paragraphs of paper i are rows paper_paragraph_indptr[i] to
+# paper_paragraph_indptr[i+1] (exclusive) of the paragraph columns
+INDPTR_COLUMNS = [
+    "paper_paragraph_indptr",
+    "paragraph_content_id_indptr",
+    "paragraph_text_indptr",
+    "paragraph_marker_indptr",
+    "marker_referenced_content_id_indptr",
+]
+marker_type2code = {t: i for i, t in enumerate(allowed_reference_marker_types)}
+
+def flatten_papers(lines: list[str]) -> dict[str, np.ndarray]:
+    # flatten a batch of papers.jsonl lines into columns. the indptr columns hold row lengths here, which
+    # ColumnarWriter turns into offsets that are valid across batches
+    columns = {name: [] for name in [*DATA_COLUMNS, *INDPTR_COLUMNS]}
+    texts = []
+    for line in lines:
+        paper = json.loads(line)
+        paragraphs = get_paragraphs_flat(paper)
+        columns["paper_corpusid"].append(paper["corpusid"])
+        columns["paper_paragraph_indptr"].append(len(paragraphs))
+
+        for paragraph in paragraphs:
+            columns["paragraph_content_id"] += paragraph["content_id"]
+            columns["paragraph_content_id_indptr"].append(len(paragraph["content_id"]))
+
+            span = paragraph["original_span"] or {"start": MISSING, "end": MISSING}
+            columns["paragraph_start"].append(span["start"])
+            columns["paragraph_end"].append(span["end"])
+
+            text = paragraph["text"].encode("utf-8")
+            texts.append(text)
+            columns["paragraph_text_indptr"].append(len(text))
+
+            markers = paragraph["reference_markers"]
+            columns["paragraph_marker_indptr"].append(len(markers))
+            for marker in markers:
+                columns["marker_type"].append(marker_type2code[marker["reference_marker_type"]])
+                span = marker["original_span"] or {"start": MISSING, "end": MISSING}
+                columns["marker_start"].append(span["start"])
+                columns["marker_end"].append(span["end"])
+
+                referenced_id = marker["referenced_id"]
+                if isinstance(referenced_id, int):
+                    columns["marker_referenced_id"].append(referenced_id)
+                    columns["marker_referenced_content_id_indptr"].append(0)
+                else:
+                    referenced_content_id = referenced_id or []
+                    columns["marker_referenced_id"].append(MISSING)
+                    columns["marker_referenced_content_id"] += referenced_content_id
+                    columns["marker_referenced_content_id_indptr"].append(len(referenced_content_id))
+
+    out = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in DATA_COLUMNS.items() if name != "paragraph_text"}
+    out["paragraph_text"] = np.frombuffer(b"".join(texts), dtype=np.uint8)
+    out.update({name: np.asarray(columns[name], dtype=np.int64) for name in INDPTR_COLUMNS})
+    return out
+
+class ColumnarWriter:
+    def __init__(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        # columns.json is written last and marks a complete export, so that of a previous export must not outlive
+        # this one if it fails
+        if os.path.exists(os.path.join(out_dir, META_FILENAME)):
+            os.remove(os.path.join(out_dir, META_FILENAME))
+        self.data_appenders = {
+            name: NpyAppender(os.path.join(out_dir, f"{name}.npy"), dtype) for name, dtype in DATA_COLUMNS.items()
+        }
+        self.indptr_appenders = {name: IndptrAppender(os.path.join(out_dir, f"{name}.npy")) for name in INDPTR_COLUMNS}
+
+    def append(self, columns: dict[str, np.ndarray]):
+        for name, appender in self.data_appenders.items():
+            appender.append(columns[name])
+        for name, appender in self.indptr_appenders.items():
+            appender.append_lengths(columns[name])
+
+    def close(self):
+        for appender in [*self.data_appenders.values(), *self.indptr_appenders.values()]:
+            appender.close()
+
+        meta = {
+            "num_papers": self.data_appenders["paper_corpusid"].length,
+            "num_paragraphs": self.data_appenders["paragraph_start"].length,
+            "num_markers": self.data_appenders["marker_type"].length,
+            "marker_types": allowed_reference_marker_types,
+        }
+        with open(os.path.join(self.out_dir, META_FILENAME), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self) -> "ColumnarWriter":
+        return self
+
+    def abort(self):
+        for appender in [*self.data_appenders.values(), *self.indptr_appenders.values()]:
+            appender.abort()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def load_columnar(out_dir: str, mmap_mode: str | None = "r") -> dict[str, np.ndarray]:
+    # memory-maps every column by default, so that only the pages that are actually used get read
+    assert os.path.exists(os.path.join(out_dir, META_FILENAME)), \
+        f"{out_dir} is not a complete export (no {META_FILENAME})"
+    return {
+        name: np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        for name in [*DATA_COLUMNS, *INDPTR_COLUMNS]
+    }
+
+def get_paragraph_text(columns: dict[str, np.ndarray], paragraph_idx: int) -> str:
+    indptr = columns["paragraph_text_indptr"]
+    return columns["paragraph_text"][indptr[paragraph_idx]:indptr[paragraph_idx+1]].tobytes().decode("utf-8")
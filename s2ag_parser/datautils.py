@@ -1,3 +1,6 @@
+from collections import defaultdict
+from typing import Callable, Container, Iterable, Iterator
+
 def is_paper(x: dict) -> bool:
     return all(key in x for key in ["corpusid", "contents", "bibliography"])
 
@@ -77,26 +80,63 @@ def get_content(x: dict, content_id: list[int]) -> dict:
 def has_contents(x: dict) -> bool:
     return "contents" in x
 
+def iter_contents(
+        x: dict, 
+        content_types: Container[str] | None = None, 
+        min_depth: int | None = None, 
+        max_depth: int | None = None,
+    ) -> Iterator[tuple[list[int], dict]]:
+    # yield (content_id, content) for x (if it is a content) and everything nested in it, in document order. the
+    # depth of a content is the length of its content_id, i.e. 1 for top-level sections. contents deeper than
+    # max_depth are not visited at all. the tree is walked with an explicit stack, one content at a time, so
+    # stopping early skips the rest of the walk
+    start_depth = len(get_content_id(x)) if is_content(x) else 0
+    stack = [(iter((x,)), start_depth)]
+    while stack:
+        # resume the innermost unfinished list of contents. descending into a content pauses it (break), and it is
+        # popped once exhausted (else). the checks of is_content and has_contents are inlined, as this is the hot loop
+        contents, depth = stack[-1]
+        for content in contents:
+            if "content_id" in content and "content_type" in content \
+                and (content_types is None or content["content_type"] in content_types) \
+                and (min_depth is None or depth >= min_depth):
+                yield content["content_id"], content
+            if "contents" in content and (max_depth is None or depth < max_depth):
+                stack.append((iter(content["contents"]), depth + 1))
+                break
+        else:
+            stack.pop()
+
+def iter_sections(x: dict, **kwargs) -> Iterator[tuple[list[int], dict]]:
+    return iter_contents(x, content_types=("section",), **kwargs)
+
+def iter_paragraphs(x: dict, **kwargs) -> Iterator[tuple[list[int], dict]]:
+    return iter_contents(x, content_types=("paragraph",), **kwargs)
+
+def fan_out(items: Iterable, consumers: list[Callable[..., bool | None]]):
+    # feed every item to every consumer in a single pass, e.g. the (content_id, content) pairs of iter_contents.
+    # a consumer that returns True is done and gets no further items; the pass stops once all consumers are done
+    active = list(consumers)
+    for item in items:
+        active = [consumer for consumer in active if not consumer(*item if isinstance(item, tuple) else (item,))]
+        if not active:
+            break
+
+def group_contents_by_type(x: dict, **kwargs) -> dict[str, list[dict]]:
+    # all contents of x by content type in a single pass, e.g. group_contents_by_type(paper)["paragraph"]
+    content_type2contents = defaultdict(list)
+    for _, content in iter_contents(x, **kwargs):
+        content_type2contents[get_content_type(content)].append(content)
+    return dict(content_type2contents)
+
 def get_contents_flat(x: dict) -> list[dict]:
-    contents_flat = [x] if is_content(x) else []
-    if has_contents(x):
-        for content in get_contents(x):
-            contents_flat += get_contents_flat(content)
-    return contents_flat
+    return [content for _, content in iter_contents(x)]
 
 def get_sections_flat(x: dict) -> list[dict]:
-    sections_flat = [x] if is_section(x) else []
-    if has_contents(x):
-        for content in get_contents(x):
-            sections_flat += get_sections_flat(content)
-    return sections_flat
+    return [content for _, content in iter_sections(x)]
 
 def get_paragraphs_flat(x: dict) -> list[dict]:
-    paragrahs_flat = [x] if is_paragraph(x) else []
-    if has_contents(x):
-        for content in get_contents(x):
-            paragrahs_flat += get_paragraphs_flat(content)
-    return paragrahs_flat
+    return [content for _, content in iter_paragraphs(x)]
 
 ## General utils
 def strip_whitespace(x: str, delimiter: str) -> str:
@@ -0,0 +1,288 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from s2ag_parser.array_utils import IndptrAppender, NpyAppender
+from s2ag_parser.datautils import get_bibliography, get_corpusid
+from s2ag_parser.sort_utils import DEFAULT_MAX_MEMORY_BYTES
+
+META_FILENAME = "graph.json"
+EDGE_OVERHEAD_BYTES = 48        # rough memory per edge while sorting a bucket: row, col, their sorted copies and order
+DIRECTIONS = ["out", "in"]      # out: citing -> cited, in: cited -> citing
+
+# the graph is stored as
+#   node_corpusid.npy: the corpusids of all nodes, sorted; a node is addressed by its position in this array
+#   node_is_paper.npy: whether a node is a parsed paper, rather than only cited by one
+#   {direction}_indptr.npy, {direction}_indices.npy: the neighbours of node i are nodes
+#       {direction}_indices[{direction}_indptr[i]:{direction}_indptr[i+1]], sorted
+
+def extract_citations(lines: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # the corpusids of a batch of papers.jsonl lines, and their citations as (citing, cited) corpusids. a paper
+    # that lists the same cited paper more than once in its bibliography cites it once
+    corpusids, src, dst = [], [], []
+    for line in lines:
+        paper = json.loads(line)
+        corpusid = get_corpusid(paper)
+        cited = sorted({entry["corpusid"] for entry in get_bibliography(paper) if entry["corpusid"] is not None})
+        corpusids.append(corpusid)
+        src += [corpusid] * len(cited)
+        dst += cited
+    return tuple(np.asarray(x, dtype=np.int64) for x in (corpusids, src, dst))
+
+def iter_chunks(x: np.ndarray, chunk_size: int):
+    for i in range(0, len(x), chunk_size):
+        yield np.asarray(x[i:i+chunk_size])
+
+def get_index_dtype(num_nodes: int) -> np.dtype:
+    return np.dtype(np.int32 if num_nodes < np.iinfo(np.int32).max else np.int64)
+
+def write_csr(
+        nodes: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        indptr_path: str,
+        indices_path: str,
+        tmp_dir: str,
+        chunk_size: int,
+    ) -> int:
+    # write the edges rows[i] -> cols[i] (corpusids) in CSR form, with bounded memory: the edges are split on disk
+    # into buckets of consecutive rows with at most chunk_size edges each (unless a single block of rows has more),
+    # which are then sorted one at a time. duplicate edges are dropped. besides nodes, every array in memory has at
+    # most chunk_size elements, whatever the number of nodes. returns the number of edges written
+    num_nodes = len(nodes)
+    index_dtype = get_index_dtype(num_nodes)
+
+    # upper bounds of the number of edges (before duplicates are dropped) of every block of block_size consecutive
+    # rows, to choose the buckets. with at most chunk_size nodes, blocks are single rows
+    block_size = max(-(-num_nodes // chunk_size), 1)
+    num_blocks = -(-num_nodes // block_size)
+    block_lengths = np.zeros(num_blocks, dtype=np.int64)
+    for chunk in iter_chunks(rows, chunk_size):
+        block_lengths += np.bincount(np.searchsorted(nodes, chunk) // block_size, minlength=num_blocks)
+    ends = np.cumsum(block_lengths)
+    targets = np.arange(chunk_size, int(block_lengths.sum()), chunk_size)
+    block_bounds = np.unique([0, *np.searchsorted(ends, targets, side="right"), num_blocks])
+    bounds = np.minimum(block_bounds * block_size, num_nodes)
+    del block_lengths, ends, targets
+
+    # first pass: distribute the edges (as node positions) over the buckets
+    bucket_paths = [
+        (os.path.join(tmp_dir, f"bucket-{b:05d}.row.npy"), os.path.join(tmp_dir, f"bucket-{b:05d}.col.npy"))
+        for b in range(len(bounds) - 1)
+    ]
+    appenders = [
+        (NpyAppender(row_path, index_dtype), NpyAppender(col_path, index_dtype)) for row_path, col_path in bucket_paths
+    ]
+    for row_chunk, col_chunk in zip(iter_chunks(rows, chunk_size), iter_chunks(cols, chunk_size)):
+        row_idxs = np.searchsorted(nodes, row_chunk).astype(index_dtype)
+        col_idxs = np.searchsorted(nodes, col_chunk).astype(index_dtype)
+        buckets = np.searchsorted(bounds, row_idxs, side="right") - 1
+        order = np.argsort(buckets, kind="stable")
+        splits = np.cumsum(np.bincount(buckets, minlength=len(appenders)))[:-1]
+        for (row_appender, col_appender), idxs in zip(appenders, np.split(order, splits)):
+            row_appender.append(row_idxs[idxs])
+            col_appender.append(col_idxs[idxs])
+    for row_appender, col_appender in appenders:
+        row_appender.close()
+        col_appender.close()
+
+    # second pass: sort each bucket by (row, col), and append it
+    num_edges = 0
+    with IndptrAppender(indptr_path) as indptr_appender, NpyAppender(indices_path, index_dtype) as indices_appender:
+        for b, (row_path, col_path) in enumerate(bucket_paths):
+            row_idxs, col_idxs = np.load(row_path), np.load(col_path)
+            order = np.lexsort((col_idxs, row_idxs))
+            row_idxs, col_idxs = row_idxs[order], col_idxs[order]
+            keep = np.ones(len(row_idxs), dtype=bool)
+            keep[1:] = (row_idxs[1:] != row_idxs[:-1]) | (col_idxs[1:] != col_idxs[:-1])
+
+            indices_appender.append(col_idxs[keep])
+            # a bucket can span many more rows than it has edges, so its row lengths are appended chunk by chunk
+            row_idxs = row_idxs[keep]
+            for start in range(bounds[b], bounds[b+1], chunk_size):
+                end = min(start + chunk_size, bounds[b+1])
+                indptr_appender.append_lengths(np.diff(np.searchsorted(row_idxs, np.arange(start, end + 1))))
+            num_edges += len(row_idxs)
+            os.remove(row_path)
+            os.remove(col_path)
+    return num_edges
+
+def write_citation_graph(
+        paper_corpusid_path: str,
+        src_path: str,
+        dst_path: str,
+        out_dir: str,
+        max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    ):
+    # write the graph of the citations src[i] -> dst[i] between the papers in paper_corpusid_path (and the papers
+    # they cite), from .npy files of corpusids
+    paper_corpusids = np.load(paper_corpusid_path, mmap_mode="r")
+    src = np.load(src_path, mmap_mode="r")
+    dst = np.load(dst_path, mmap_mode="r")
+    chunk_size = max(max_memory_bytes // EDGE_OVERHEAD_BYTES, 1)
+
+    # every citing paper is a parsed paper, so only the cited ones can add nodes
+    paper_nodes = np.unique(paper_corpusids)
+    nodes = np.unique(np.concatenate([paper_nodes, *[np.unique(chunk) for chunk in iter_chunks(dst, chunk_size)]]))
+    np.save(os.path.join(out_dir, "node_corpusid.npy"), nodes)
+    np.save(os.path.join(out_dir, "node_is_paper.npy"), np.isin(nodes, paper_nodes, assume_unique=True))
+
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        num_edges = {}
+        for direction, rows, cols in [("out", src, dst), ("in", dst, src)]:
+            num_edges[direction] = write_csr(
+                nodes, rows, cols,
+                os.path.join(out_dir, f"{direction}_indptr.npy"),
+                os.path.join(out_dir, f"{direction}_indices.npy"),
+                tmp_dir, chunk_size,
+            )
+    assert num_edges["out"] == num_edges["in"]
+
+    meta = {
+        "num_nodes": len(nodes),
+        "num_papers": len(paper_nodes),
+        "num_edges": num_edges["out"],
+    }
+    with open(os.path.join(out_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+class CitationGraphBuilder:
+    # collects the output of extract_citations batch by batch on disk, and writes the graph on close
+    def __init__(self, out_dir: str, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        # graph.json is written last and marks a complete graph, so that of a previous graph must not outlive this
+        # one if it fails
+        if os.path.exists(os.path.join(out_dir, META_FILENAME)):
+            os.remove(os.path.join(out_dir, META_FILENAME))
+        self.max_memory_bytes = max_memory_bytes
+        self.tmp_dir = tempfile.TemporaryDirectory(dir=out_dir)
+        self.appenders = [
+            NpyAppender(os.path.join(self.tmp_dir.name, f"{name}.npy"), np.int64)
+            for name in ["paper_corpusid", "src", "dst"]
+        ]
+
+    def append(self, corpusids: np.ndarray, src: np.ndarray, dst: np.ndarray):
+        for appender, values in zip(self.appenders, [corpusids, src, dst]):
+            appender.append(values)
+
+    def close(self):
+        try:
+            for appender in self.appenders:
+                appender.close()
+            write_citation_graph(*[appender.path for appender in self.appenders], self.out_dir, self.max_memory_bytes)
+        finally:
+            self.tmp_dir.cleanup()
+
+    def abort(self):
+        # drop what was collected without writing the graph, so that a failed run does not leave a partial graph
+        for appender in self.appenders:
+            appender.abort()
+        self.tmp_dir.cleanup()
+
+    def __enter__(self) -> "CitationGraphBuilder":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class CitationGraph:
+    # read-only view of a graph written by write_citation_graph. every array is memory-mapped, so opening a graph is
+    # near-instant and a query only reads the pages of the nodes it touches. nodes are given and returned as
+    # corpusids, and direction is "out" (the papers cited by a paper), "in" (the papers citing it) or "both"
+    def __init__(self, out_dir: str):
+        assert os.path.exists(os.path.join(out_dir, META_FILENAME)), \
+            f"{out_dir} is not a complete graph (no {META_FILENAME})"
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode="r")
+        self.node_corpusid = load("node_corpusid")
+        self.node_is_paper = load("node_is_paper")
+        self.csr = {direction: (load(f"{direction}_indptr"), load(f"{direction}_indices")) for direction in DIRECTIONS}
+
+    def __len__(self) -> int:
+        return len(self.node_corpusid)
+
+    def __contains__(self, corpusid: int) -> bool:
+        return self.get_node(corpusid) is not None
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.csr["out"][1])
+
+    def get_node(self, corpusid: int) -> int | None:
+        i = np.searchsorted(self.node_corpusid, corpusid)
+        if i < len(self.node_corpusid) and self.node_corpusid[i] == corpusid:
+            return int(i)
+        return None
+
+    def find_nodes(self, corpusids: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        # the would-be positions of corpusids, and whether each of them is in the graph
+        corpusids = np.asarray(corpusids, dtype=np.int64)
+        idxs = np.searchsorted(self.node_corpusid, corpusids)
+        found = idxs < len(self.node_corpusid)
+        found[found] = self.node_corpusid[idxs[found]] == corpusids[found]
+        return idxs, found
+
+    def get_nodes(self, corpusids: list[int]) -> np.ndarray:
+        # positions of the corpusids that are in the graph; the others are left out
+        idxs, found = self.find_nodes(corpusids)
+        return idxs[found]
+
+    def is_paper(self, corpusid: int) -> bool:
+        node = self.get_node(corpusid)
+        return node is not None and bool(self.node_is_paper[node])
+
+    def get_directions(self, direction: str) -> list[str]:
+        if direction == "both":
+            return DIRECTIONS
+        if direction not in DIRECTIONS:
+            raise ValueError(f"direction must be one of {DIRECTIONS + ['both']}, got {direction!r}")
+        return [direction]
+
+    def gather_neighbor_nodes(self, nodes: np.ndarray, direction: str = "out") -> np.ndarray:
+        # the neighbours of all nodes, concatenated (with repeats), gathered in one vectorized read per direction
+        neighbors = []
+        for _direction in self.get_directions(direction):
+            indptr, indices = self.csr[_direction]
+            starts, ends = indptr[nodes], indptr[nodes + 1]
+            lengths = ends - starts
+            offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+            neighbors.append(np.asarray(indices[offsets], dtype=np.int64))
+        return np.concatenate(neighbors)
+
+    def get_neighbors(self, corpusid: int, direction: str = "out") -> np.ndarray:
+        # sorted corpusids of the neighbours; empty for corpusids that are not in the graph
+        nodes = self.get_nodes([corpusid])
+        return self.node_corpusid[np.unique(self.gather_neighbor_nodes(nodes, direction))]
+
+    def get_degree(self, corpusid: int, direction: str = "out") -> int:
+        return int(self.get_degrees([corpusid], direction)[0])
+
+    def get_degrees(self, corpusids: list[int], direction: str = "out") -> np.ndarray:
+        # 0 for corpusids that are not in the graph. with direction="both", a paper that cites and is cited by the
+        # same paper counts it twice
+        idxs, found = self.find_nodes(corpusids)
+        nodes = idxs[found]
+        degrees = np.zeros(len(idxs), dtype=np.int64)
+        for _direction in self.get_directions(direction):
+            indptr, _ = self.csr[_direction]
+            degrees[found] += indptr[nodes + 1] - indptr[nodes]
+        return degrees
+
+    def get_k_hop_neighbors(self, corpusids: list[int], k: int, direction: str = "out") -> list[np.ndarray]:
+        # breadth-first search from corpusids: element i is the sorted corpusids first reached after i+1 hops
+        visited = np.unique(self.get_nodes(corpusids))
+        frontier = visited
+        hops = []
+        for _ in range(k):
+            frontier = np.setdiff1d(
+                np.unique(self.gather_neighbor_nodes(frontier, direction)), visited, assume_unique=True,
+            )
+            visited = np.union1d(visited, frontier)
+            hops.append(self.node_corpusid[frontier])
+        return hops
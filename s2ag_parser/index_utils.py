@@ -0,0 +1,158 @@
+import json
+import mmap
+import os
+import re
+import tempfile
+
+import numpy as np
+from tqdm import tqdm
+
+from s2ag_parser.array_utils import NpyAppender
+
+CORPUSID_PREFIX_PATTERN = re.compile(rb'^\{"corpusid": (-?\d+)[,}]')
+APPEND_BUFFER_SIZE = 1 << 20
+DEFAULT_MAX_MEMORY_BYTES = 1 << 30
+INDEX_ENTRY_BYTES = 120     # rough memory per line while sorting a run: two python ints in lists, and numpy copies
+
+def get_index_paths(data_path: str) -> tuple[str, str]:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.index.corpusid.npy, data/extracted/papers.index.offset.npy
+    root, _ = os.path.splitext(data_path)
+    return f"{root}.index.corpusid.npy", f"{root}.index.offset.npy"
+
+def parse_corpusid(line: bytes) -> int:
+    # every jsonl file written by this package starts its lines with the corpusid, so a full decode is rarely needed
+    match = CORPUSID_PREFIX_PATTERN.match(line)
+    return int(match.group(1)) if match else json.loads(line)["corpusid"]
+
+def sort_run(corpusids: list[int], offsets: list[int], run_paths: list[tuple[str, str]], run_dir: str):
+    # lines at smaller offsets come first among duplicated corpusids, here and when merging runs
+    corpusids, offsets = np.asarray(corpusids, dtype=np.int64), np.asarray(offsets, dtype=np.int64)
+    order = np.lexsort((offsets, corpusids))
+    run_paths.append((
+        os.path.join(run_dir, f"run-{len(run_paths):05d}.corpusid.npy"),
+        os.path.join(run_dir, f"run-{len(run_paths):05d}.offset.npy"),
+    ))
+    np.save(run_paths[-1][0], corpusids[order])
+    np.save(run_paths[-1][1], offsets[order])
+
+def merge_sorted_runs(run_paths: list[tuple[str, str]], corpusid_path: str, offset_path: str, block_size: int):
+    # merge runs sorted by (corpusid, offset), about block_size entries per run at a time: every entry up to the
+    # smallest corpusid that ends the next block of a run can be written, since no later entry has a smaller one.
+    # all entries equal to it are taken from every run at once, so that duplicates stay in offset order
+    runs = [(np.load(c_path, mmap_mode="r"), np.load(o_path, mmap_mode="r")) for c_path, o_path in run_paths]
+    positions = [0] * len(runs)
+    with NpyAppender(corpusid_path, np.int64) as corpusid_appender, NpyAppender(offset_path, np.int64) as offset_appender:
+        while active := [i for i, (run_corpusids, _) in enumerate(runs) if positions[i] < len(run_corpusids)]:
+            threshold = min(runs[i][0][min(positions[i] + block_size, len(runs[i][0])) - 1] for i in active)
+            corpusids, offsets = [], []
+            for i in active:
+                run_corpusids, run_offsets = runs[i]
+                end = positions[i] + np.searchsorted(run_corpusids[positions[i]:], threshold, side="right")
+                corpusids.append(np.asarray(run_corpusids[positions[i]:end]))
+                offsets.append(np.asarray(run_offsets[positions[i]:end]))
+                positions[i] = end
+            corpusids, offsets = np.concatenate(corpusids), np.concatenate(offsets)
+            order = np.lexsort((offsets, corpusids))
+            corpusid_appender.append(corpusids[order])
+            offset_appender.append(offsets[order])
+
+def build_offset_index(data_path: str, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES):
+    # write two parallel arrays, the corpusids in the data file sorted in increasing order and the byte offsets of
+    # their lines. for duplicated corpusids, the first line in the file comes first. memory stays around
+    # max_memory_bytes: sorted runs of that size are written first, and then merged
+    corpusid_path, offset_path = get_index_paths(data_path)
+    run_size = max(max_memory_bytes // INDEX_ENTRY_BYTES, 1)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(corpusid_path))) as run_dir:
+        # first pass: collect corpusids and offsets in file order, and sort them run by run
+        run_paths = []
+        with open(data_path, "rb") as f, \
+            tqdm(total=os.path.getsize(data_path), unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+            corpusids, offsets = [], []
+            offset = 0
+            for line in f:
+                corpusids.append(parse_corpusid(line))
+                offsets.append(offset)
+                offset += len(line)
+
+                if len(corpusids) >= run_size:
+                    sort_run(corpusids, offsets, run_paths, run_dir)
+                    pbar.update(offset - pbar.n)
+                    corpusids, offsets = [], []
+            if corpusids or not run_paths:
+                sort_run(corpusids, offsets, run_paths, run_dir)
+            pbar.update(offset - pbar.n)
+
+        # second pass: merge the runs
+        if len(run_paths) == 1:
+            os.replace(run_paths[0][0], corpusid_path)
+            os.replace(run_paths[0][1], offset_path)
+        else:
+            merge_sorted_runs(run_paths, corpusid_path, offset_path, max(run_size // len(run_paths), 1))
+
+class OffsetIndexReader:
+    # random access to the lines of a jsonl file by corpusid. both the data file and the index are memory-mapped,
+    # so opening a reader is near-instant and only the pages that are looked up get read
+    def __init__(self, data_path: str):
+        corpusid_path, offset_path = get_index_paths(data_path)
+        self.corpusids = np.load(corpusid_path, mmap_mode="r")
+        self.offsets = np.load(offset_path, mmap_mode="r")
+
+        self.f = open(data_path, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(data_path) else b""
+
+    def __len__(self) -> int:
+        return len(self.corpusids)
+
+    def __contains__(self, corpusid: int) -> bool:
+        return self.find_offset(corpusid) is not None
+
+    def find_offset(self, corpusid: int) -> int | None:
+        i = np.searchsorted(self.corpusids, corpusid)
+        if i < len(self.corpusids) and self.corpusids[i] == corpusid:
+            return int(self.offsets[i])
+        return None
+
+    def read_line(self, offset: int) -> bytes:
+        end = self.data.find(b"\n", offset)
+        return self.data[offset:end if end >= 0 else len(self.data)]
+
+    def get_line(self, corpusid: int) -> bytes | None:
+        offset = self.find_offset(corpusid)
+        return None if offset is None else self.read_line(offset)
+
+    def get(self, corpusid: int) -> dict | None:
+        line = self.get_line(corpusid)
+        return None if line is None else json.loads(line)
+
+    def find_offsets(self, corpusids: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        # one vectorized search for all corpusids: the positions in corpusids of those that are indexed, and their
+        # offsets
+        corpusids = np.asarray(corpusids, dtype=np.int64)
+        idxs = np.searchsorted(self.corpusids, corpusids)
+        found = idxs < len(self.corpusids)
+        found[found] = self.corpusids[idxs[found]] == corpusids[found]
+        found_idxs = np.flatnonzero(found)
+        return found_idxs, np.asarray(self.offsets[idxs[found_idxs]], dtype=np.int64)
+
+    def get_lines(self, corpusids: list[int]) -> list[bytes | None]:
+        # the lines are read in file order to keep access sequential
+        found_idxs, offsets = self.find_offsets(corpusids)
+        lines = [None] * len(corpusids)
+        for i in np.argsort(offsets, kind="stable"):
+            lines[found_idxs[i]] = self.read_line(int(offsets[i]))
+        return lines
+
+    def get_many(self, corpusids: list[int]) -> list[dict | None]:
+        return [None if line is None else json.loads(line) for line in self.get_lines(corpusids)]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+    def __enter__(self) -> "OffsetIndexReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,46 @@
+from bisect import bisect_left, bisect_right
+
+class IntervalIndex:
+    # static index over half-open [start, end) intervals. intervals are grouped by length class (lengths within a
+    # factor of 2 of each other), and kept sorted by start within each group. a query bisects every group to the
+    # intervals that start close enough to overlap it, so that a few long intervals (e.g. a whole-document annotation)
+    # do not widen the search among the many short ones. queries return the positions of the matching intervals in the
+    # list the index was built from, in increasing order
+    def __init__(self, intervals: list[tuple[int, int]]):
+        class2ids = {}
+        for i, (start, end) in enumerate(intervals):
+            class2ids.setdefault(max(end - start, 0).bit_length(), []).append(i)
+
+        self.groups = []    # (ids, starts, ends, max_len) per length class
+        for ids in class2ids.values():
+            ids.sort(key=lambda i: intervals[i][0])
+            self.groups.append((
+                ids,
+                [intervals[i][0] for i in ids],
+                [intervals[i][1] for i in ids],
+                max(intervals[i][1] - intervals[i][0] for i in ids),
+            ))
+        self.num_intervals = len(intervals)
+
+    def __len__(self) -> int:
+        return self.num_intervals
+
+    def overlapping(self, start: int, end: int) -> list[int]:
+        # intervals that share at least one position with [start, end). an interval starting at or before
+        # start - max_len of its group also ends at or before start, so the candidates of a group are those starting in
+        # (start - max_len, end)
+        matches = []
+        for ids, starts, ends, max_len in self.groups:
+            lo = bisect_right(starts, start - max_len)
+            hi = bisect_left(starts, end)
+            matches += [ids[k] for k in range(lo, hi) if ends[k] > start]
+        return sorted(matches)
+
+    def contained_in(self, start: int, end: int) -> list[int]:
+        # intervals that lie entirely within [start, end)
+        matches = []
+        for ids, starts, ends, _ in self.groups:
+            lo = bisect_left(starts, start)
+            hi = bisect_right(starts, end)
+            matches += [ids[k] for k in range(lo, hi) if ends[k] <= end]
+        return sorted(matches)
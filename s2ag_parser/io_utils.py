@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+import gzip
+from itertools import islice
+import json
+import os
+from typing import Any, Callable, Iterable, Iterator
+
+from tqdm import tqdm
+
+GZIP_MAGIC = b"\x1f\x8b"
+PROGRESS_UPDATE_BYTES = 1 << 20
+COPY_BUFFER_BYTES = 16 << 20
+
+@contextmanager
+def atomic_output(path: str) -> Iterator[str]:
+    # yield a temporary path to write to, which is renamed to path only once writing succeeded. path is therefore
+    # either complete or absent, even if the process dies halfway
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def is_gzipped(filepath: str) -> bool:
+    with open(filepath, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+def iter_lines(
+        filepath: str,
+        start: int = 0,
+        end: int | None = None,
+        progress: bool = True,
+        decode: bool = True,
+    ) -> Iterator[str | bytes]:
+    # lazily yield lines from a plain or gzipped shard, so that memory stays bounded regardless of shard size.
+    # progress is reported in bytes of the file on disk (i.e. compressed bytes for .gz), so tqdm can show an ETA.
+    # for plain shards, only the lines within the byte range [start, end) are read; start and end are expected
+    # to be aligned to line starts (see split_byte_ranges). with decode=False, lines are yielded as raw bytes
+    size = os.path.getsize(filepath)
+    end = size if end is None else end
+    gzipped = is_gzipped(filepath)
+    assert not gzipped or (start == 0 and end == size), f"Gzipped shard {filepath} can only be read as a whole"
+    if start >= end:
+        return
+
+    with open(filepath, "rb") as f_raw, \
+        tqdm(total=end-start, unit="B", unit_scale=True, unit_divisor=1024, disable=not progress) as pbar:
+        if gzipped:
+            f = gzip.GzipFile(fileobj=f_raw, mode="rb")
+        else:
+            f_raw.seek(start)
+            f = f_raw
+
+        reported = start
+        for line in f:
+            yield line.decode("utf-8") if decode else line
+
+            # f_raw.tell() is cheap, but updating tqdm for every line is not
+            position = f_raw.tell()
+            if position - reported >= PROGRESS_UPDATE_BYTES:
+                pbar.update(position - reported)
+                reported = position
+            if not gzipped and position >= end:
+                break
+        pbar.update(end - reported)
+
+def iter_lines_from_files(filepaths: list[str], progress: bool = True) -> Iterator[str]:
+    for i, filepath in enumerate(filepaths):
+        print(f"Filepath {i}: {filepath}")
+        yield from iter_lines(filepath, progress=progress)
+
+def split_byte_ranges(
+        filepath: str,
+        range_size: int,
+        start: int = 0,
+        end: int | None = None,
+    ) -> list[tuple[str, int, int]]:
+    # split a shard (or the bytes [start, end) of it, which must be aligned to line starts) into (filepath, start,
+    # end) ranges of roughly range_size bytes, aligned to line starts. gzipped shards cannot be seeked into, so they
+    # always form a single range
+    end = os.path.getsize(filepath) if end is None else end
+    if end == start or is_gzipped(filepath):
+        return [(filepath, start, end)]
+
+    offsets = [start]
+    with open(filepath, "rb") as f:
+        for target in range(start + range_size, end, range_size):
+            if target <= offsets[-1]:
+                continue
+
+            # skip to the start of the next line (reading from target-1 keeps target if it already is a line start)
+            f.seek(target - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= end:
+                break
+            offsets.append(offset)
+    offsets.append(end)
+
+    return [(filepath, range_start, range_end) for range_start, range_end in zip(offsets, offsets[1:])]
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def encode_json_line(obj: Any, encode: Callable[[Any], str] = json.dumps) -> bytes:
+    # the same bytes as print(json.dumps(obj), file=f). encode can be swapped for a faster encoder, but only one
+    # that matches json.dumps with its default settings (separators, ensure_ascii) keeps the output byte-identical
+    return (encode(obj) + "\n").encode("utf-8")
+
+def get_part_path(out_path: str, part_idx: int, shard: str | None = None) -> str:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.part-00007.jsonl, or with shard="s2orc-3.gz",
+    # data/extracted/papers.s2orc-3.gz.part-00007.jsonl. naming parts by shard keeps them stable across reruns
+    root, ext = os.path.splitext(out_path)
+    if shard is not None:
+        root = f"{root}.{shard}"
+    return f"{root}.part-{part_idx:05d}{ext}"
+
+def get_manifest_path(out_path: str) -> str:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.manifest.json
+    root, _ = os.path.splitext(out_path)
+    return f"{root}.manifest.json"
+
+def write_manifest(manifest_path: str, parts: list[dict]):
+    with atomic_output(manifest_path) as tmp_path, open(tmp_path, "w") as f:
+        json.dump({"parts": parts}, f, indent=2)
+
+def read_manifest(manifest_path: str) -> list[dict]:
+    with open(manifest_path, "r") as f:
+        return json.load(f)["parts"]
+
+def get_part_range(part: dict) -> tuple[str, int, int]:
+    # (path, start, end) of the bytes of a manifest part: a whole part file, or a slice of a merged file
+    if "offset" in part:
+        return part["path"], part["offset"], part["offset"] + part["num_bytes"]
+    return part["path"], 0, os.path.getsize(part["path"])
+
+def concat_ranges(byte_ranges: list[tuple[str, int, int]], out_path: str):
+    # out_path may be one of the inputs, since it is only replaced once everything has been copied
+    with atomic_output(out_path) as tmp_path, open(tmp_path, "wb") as f_out:
+        for filepath, start, end in tqdm(byte_ranges):
+            with open(filepath, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining and (chunk := f.read(min(COPY_BUFFER_BYTES, remaining))):
+                    f_out.write(chunk)
+                    remaining -= len(chunk)
+
+def concat_files(filepaths: list[str], out_path: str):
+    concat_ranges([(filepath, 0, os.path.getsize(filepath)) for filepath in filepaths], out_path)
+
+def merge_parts(manifest_path: str, out_path: str) -> list[dict]:
+    # concatenate the parts listed in a manifest, in manifest order, into a single file. returns the parts as
+    # slices of out_path, i.e. with their path replaced by out_path and an offset and num_bytes within it
+    parts = read_manifest(manifest_path)
+    byte_ranges = [get_part_range(part) for part in parts]
+    concat_ranges(byte_ranges, out_path)
+
+    merged_parts, offset = [], 0
+    for part, (_, start, end) in zip(parts, byte_ranges):
+        merged_parts.append({**part, "path": out_path, "offset": offset, "num_bytes": end - start})
+        offset += end - start
+    return merged_parts
@@ -0,0 +1,75 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from s2ag_parser.array_utils import IndptrAppender, NpyAppender
+from s2ag_parser.index_utils import APPEND_BUFFER_SIZE
+
+MISSING_YEAR = -1
+
+def get_lookup_paths(lookup_dir: str) -> dict[str, str]:
+    return {
+        name: os.path.join(lookup_dir, f"{name}.npy")
+        for name in ["corpusid", "year", "title", "title_indptr"]
+    }
+
+def build_metadata_lookup(metadata_path: str, lookup_dir: str):
+    # write the title and year of every corpusid as flat arrays: sorted corpusids, years, and the utf-8 bytes of all
+    # titles concatenated with their offsets. metadata.jsonl is already sorted by corpusid (see build_metadata.py),
+    # so this is a single streaming pass. for duplicated corpusids, the first entry is kept
+    os.makedirs(lookup_dir, exist_ok=True)
+    paths = get_lookup_paths(lookup_dir)
+    with open(metadata_path, "rb") as f, \
+        NpyAppender(paths["corpusid"], np.int64) as corpusid_appender, \
+        NpyAppender(paths["year"], np.int32) as year_appender, \
+        NpyAppender(paths["title"], np.uint8) as title_appender, \
+        IndptrAppender(paths["title_indptr"]) as title_indptr_appender:
+
+        def flush():
+            corpusid_appender.append(corpusids)
+            year_appender.append(years)
+            title_appender.append(np.frombuffer(b"".join(titles), dtype=np.uint8))
+            title_indptr_appender.append_lengths([len(title) for title in titles])
+
+        corpusids, years, titles = [], [], []
+        prev_corpusid = None
+        for line in tqdm(f):
+            metadata = json.loads(line)
+            corpusid = metadata["corpusid"]
+            if prev_corpusid is not None and corpusid <= prev_corpusid:
+                if corpusid == prev_corpusid:
+                    continue
+                raise ValueError(f"{metadata_path} is not sorted by corpusid ({corpusid} after {prev_corpusid})")
+            prev_corpusid = corpusid
+
+            corpusids.append(corpusid)
+            years.append(MISSING_YEAR if metadata["year"] is None else metadata["year"])
+            titles.append((metadata["title"] or "").encode("utf-8"))
+            if len(corpusids) >= APPEND_BUFFER_SIZE:
+                flush()
+                corpusids, years, titles = [], [], []
+        flush()
+
+class MetadataLookup:
+    # title and year by corpusid. all arrays are memory-mapped read-only, so every process that opens the same
+    # lookup shares one copy in the page cache instead of holding its own
+    def __init__(self, lookup_dir: str):
+        paths = get_lookup_paths(lookup_dir)
+        self.corpusids = np.load(paths["corpusid"], mmap_mode="r")
+        self.years = np.load(paths["year"], mmap_mode="r")
+        self.titles = np.load(paths["title"], mmap_mode="r")
+        self.title_indptr = np.load(paths["title_indptr"], mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.corpusids)
+
+    def get(self, corpusid: int) -> dict | None:
+        i = np.searchsorted(self.corpusids, corpusid)
+        if i == len(self.corpusids) or self.corpusids[i] != corpusid:
+            return None
+
+        year = int(self.years[i])
+        title = self.titles[self.title_indptr[i]:self.title_indptr[i+1]].tobytes().decode("utf-8")
+        return {"title": title, "year": None if year == MISSING_YEAR else year}
@@ -0,0 +1,172 @@
+import json
+import os
+import time
+
+from s2ag_parser.io_utils import atomic_output
+
+DEFAULT_METRICS_INTERVAL_SECONDS = 30.
+METRIC_PREFIX = "s2ag_build"
+
+COUNTERS = {
+    "lines": "Input lines processed",
+    "papers": "Output records written",
+    "failures": "Input lines that could not be processed",
+    "input_bytes": "Input bytes processed (compressed bytes for gzipped shards)",
+    "output_bytes": "Output bytes written",
+}
+
+def get_metrics_paths(out_path: str, metrics_dir: str | None = None) -> tuple[str, str]:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.metrics.prom, data/extracted/papers.metrics.json.
+    # the prometheus node exporter only reads *.prom files from its textfile directory, so it can be set instead
+    root, _ = os.path.splitext(out_path)
+    if metrics_dir is not None:
+        root = os.path.join(metrics_dir, os.path.basename(root))
+    return f"{root}.metrics.prom", f"{root}.metrics.json"
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_prometheus(metrics: list[tuple[str, str, str, list[tuple[dict, float]]]]) -> str:
+    # prometheus text exposition format, from (name, type, help, [(labels, value)])
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_str = ",".join(f'{k}="{escape_label_value(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}")
+    return "\n".join(lines) + "\n"
+
+class BuildMetrics:
+    # counters, gauges and per-shard timings of a build script. a snapshot is written at most every interval_seconds
+    # (and once more at the end) as a prometheus textfile and a JSON summary, both replaced atomically
+    def __init__(
+            self,
+            out_path: str,
+            job: str,
+            num_workers: int,
+            labels: dict | None = None,
+            metrics_dir: str | None = None,
+            interval_seconds: float = DEFAULT_METRICS_INTERVAL_SECONDS,
+        ):
+        self.prom_path, self.json_path = get_metrics_paths(out_path, metrics_dir)
+        if metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+        self.labels = {"job": job, **(labels or {})}
+        self.num_workers = num_workers
+        self.interval_seconds = interval_seconds
+
+        self.start_time = time.time()
+        self.last_progress_time = self.start_time
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.busy_seconds = 0.
+        self.queue_depths = {}
+        self.backlog = 0
+        self.shards = {}        # shard -> {"status", "start_time", "seconds", and the counters of that shard}
+        self.finished = False
+
+        self.last_write_time = 0.
+        self.last_write_counters = dict(self.counters)
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counters[name] += value
+        if counts.get("lines"):
+            self.last_progress_time = time.time()
+
+    def add_busy_seconds(self, seconds: float):
+        self.busy_seconds += seconds
+
+    def set_queue_depths(self, queue_depths: dict[str, int]):
+        self.queue_depths = dict(queue_depths)
+
+    def set_backlog(self, backlog: int):
+        # units of work (shards or byte ranges) that are not done yet
+        self.backlog = backlog
+
+    def start_shard(self, shard: str):
+        self.shards[shard] = {"status": "running", "start_time": time.time()}
+
+    def finish_shard(self, shard: str, status: str = "done", seconds: float | None = None, **counts):
+        # seconds defaults to the wall time since start_shard
+        entry = self.shards.setdefault(shard, {"start_time": time.time()})
+        entry["status"] = status
+        entry["seconds"] = time.time() - entry["start_time"] if seconds is None else seconds
+        entry.update(counts)
+        self.maybe_write()
+
+    def maybe_write(self):
+        if time.time() - self.last_write_time >= self.interval_seconds:
+            self.write()
+
+    def get_summary(self) -> dict:
+        now = time.time()
+        elapsed = max(now - self.start_time, 1e-9)
+        since_last_write = max(now - max(self.last_write_time, self.start_time), 1e-9)
+        return {
+            **self.labels,
+            "finished": self.finished,
+            "start_time": self.start_time,
+            "snapshot_time": now,
+            "last_progress_time": self.last_progress_time,
+            "elapsed_seconds": elapsed,
+            "num_workers": self.num_workers,
+            "counters": dict(self.counters),
+            "rates": {f"{name}_per_second": value / elapsed for name, value in self.counters.items()},
+            "recent_rates": {
+                f"{name}_per_second": (value - self.last_write_counters[name]) / since_last_write
+                for name, value in self.counters.items()
+            },
+            "worker_utilization": self.busy_seconds / (elapsed * self.num_workers),
+            "queue_depths": self.queue_depths,
+            "backlog": self.backlog,
+            "shards": self.shards,
+        }
+
+    def get_prometheus_metrics(self, summary: dict) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        labels = self.labels
+        metrics = [
+            (f"{METRIC_PREFIX}_{name}_total", "counter", help_text, [(labels, summary["counters"][name])])
+            for name, help_text in COUNTERS.items()
+        ]
+        metrics += [
+            (f"{METRIC_PREFIX}_{name}_per_second", "gauge", f"{help_text} per second since the start of the run",
+                [(labels, summary["rates"][f"{name}_per_second"])])
+            for name, help_text in COUNTERS.items()
+        ]
+        metrics += [
+            (f"{METRIC_PREFIX}_worker_utilization", "gauge",
+                "Fraction of worker time spent processing since the start of the run",
+                [(labels, summary["worker_utilization"])]),
+            (f"{METRIC_PREFIX}_workers", "gauge", "Number of worker processes", [(labels, self.num_workers)]),
+            (f"{METRIC_PREFIX}_queue_depth", "gauge", "Batches waiting in each stage of the pipeline",
+                [(labels | {"queue": queue}, depth) for queue, depth in summary["queue_depths"].items()]),
+            (f"{METRIC_PREFIX}_backlog", "gauge", "Units of work (shards or byte ranges) not done yet",
+                [(labels, summary["backlog"])]),
+            (f"{METRIC_PREFIX}_shards", "gauge", "Number of shards by status",
+                [(labels | {"status": status}, sum(1 for shard in self.shards.values() if shard["status"] == status))
+                 for status in ["running", "done", "skipped"]]),
+            (f"{METRIC_PREFIX}_shard_duration_seconds", "gauge", "Time spent on each finished shard",
+                [(labels | {"shard": shard}, entry["seconds"])
+                 for shard, entry in self.shards.items() if entry["status"] == "done"]),
+            (f"{METRIC_PREFIX}_start_time_seconds", "gauge", "Unix time the run started",
+                [(labels, summary["start_time"])]),
+            (f"{METRIC_PREFIX}_last_progress_time_seconds", "gauge",
+                "Unix time an input line was last processed, for alerting on stalled runs",
+                [(labels, summary["last_progress_time"])]),
+            (f"{METRIC_PREFIX}_finished", "gauge", "1 once the run has finished", [(labels, int(self.finished))]),
+        ]
+        return metrics
+
+    def write(self):
+        summary = self.get_summary()
+        with atomic_output(self.json_path) as tmp_path, open(tmp_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        with atomic_output(self.prom_path) as tmp_path, open(tmp_path, "w") as f:
+            f.write(format_prometheus(self.get_prometheus_metrics(summary)))
+        self.last_write_time = summary["snapshot_time"]
+        self.last_write_counters = dict(self.counters)
+
+    def finish(self):
+        self.finished = True
+        self.write()
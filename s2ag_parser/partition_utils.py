@@ -0,0 +1,68 @@
+import heapq
+import os
+from typing import Sequence, TypeVar
+
+import numpy as np
+from tqdm import tqdm
+
+from s2ag_parser.index_utils import parse_corpusid
+from s2ag_parser.io_utils import iter_lines
+
+T = TypeVar("T")
+
+def get_partition_path(out_path: str, partition_index: int, num_partitions: int) -> str:
+    # e.g. data/extracted/papers.jsonl -> data/extracted/papers.partition-00001-of-00004.jsonl. a single partition
+    # writes to out_path itself, so unpartitioned runs are unchanged
+    if num_partitions == 1:
+        return out_path
+    root, ext = os.path.splitext(out_path)
+    return f"{root}.partition-{partition_index:05d}-of-{num_partitions:05d}{ext}"
+
+def assign_partitions(sizes: Sequence[int], num_partitions: int) -> list[int]:
+    # greedily give the largest remaining unit to the least loaded partition, so that partitions get roughly the
+    # same number of bytes. ties are broken by input order and partition index, so every node that sees the same
+    # inputs computes the same assignment without having to coordinate
+    loads = [(0, i) for i in range(num_partitions)]
+    partitions = [0] * len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        load, partition_index = heapq.heappop(loads)
+        partitions[i] = partition_index
+        heapq.heappush(loads, (load + sizes[i], partition_index))
+    return partitions
+
+def select_partition(units: Sequence[T], sizes: Sequence[int], num_partitions: int, partition_index: int) -> list[T]:
+    # the units (input shards, or byte ranges within them) assigned to one partition, in input order
+    assert 0 <= partition_index < num_partitions, f"Partition index {partition_index} not in [0, {num_partitions})"
+    partitions = assign_partitions(sizes, num_partitions)
+    return [unit for unit, partition in zip(units, partitions) if partition == partition_index]
+
+def check_partitions_present(paths: list[str]):
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing {len(missing)} of {len(paths)} partitions: {missing}")
+
+def read_corpusids(byte_ranges: list[tuple[str, int, int]]) -> np.ndarray:
+    corpusids = []
+    for filepath, start, end in byte_ranges:
+        lines = iter_lines(filepath, start, end, progress=False, decode=False)
+        corpusids.extend(parse_corpusid(line) for line in lines)
+    return np.array(corpusids, dtype=np.int64)
+
+def check_no_duplicate_corpusids(partition_byte_ranges: list[list[tuple[str, int, int]]]):
+    # every corpusid must come from a single partition; one that shows up in several means that inputs were
+    # assigned to more than one node. duplicates within a partition come from the inputs themselves, so they
+    # are only reported. partitions are given as (filepath, start, end) byte ranges, since their parts may be slices
+    # of a merged file
+    unique_corpusids = []
+    num_duplicates_within = 0
+    for byte_ranges in tqdm(partition_byte_ranges):
+        corpusids = read_corpusids(byte_ranges)
+        unique_corpusids.append(np.unique(corpusids))
+        num_duplicates_within += len(corpusids) - len(unique_corpusids[-1])
+    if num_duplicates_within:
+        print(f"Number of corpusids duplicated within a partition: {num_duplicates_within}")
+
+    corpusids = np.sort(np.concatenate(unique_corpusids))
+    duplicated = np.unique(corpusids[1:][corpusids[1:] == corpusids[:-1]])
+    if len(duplicated):
+        raise ValueError(f"{len(duplicated)} corpusids are in more than one partition, e.g. {duplicated[:10].tolist()}")
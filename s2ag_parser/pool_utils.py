@@ -0,0 +1,154 @@
+from collections import deque
+from multiprocessing.pool import Pool
+import os
+from queue import Queue
+from threading import Thread
+import time
+from typing import Callable, Iterable, Iterator
+
+from tqdm import tqdm
+
+DEFAULT_BATCH_SIZE = 256
+MAX_IN_FLIGHT_PER_WORKER = 4
+DEFAULT_QUEUE_SIZE = 64
+REPORT_INTERVAL_SECONDS = 1.
+
+_DONE = object()   # sentinel marking the end of a queue
+
+def get_num_workers(num_workers: int | None = None) -> int:
+    # default to one worker per cpu
+    return num_workers or os.cpu_count() or 1
+
+def process_batch(fn: Callable, batch: list) -> list:
+    return [fn(x) for x in batch]
+
+def process_batch_timed(fn: Callable, batch: list) -> tuple[list, float]:
+    # also return the time the worker spent on the batch
+    start = time.perf_counter()
+    results = [fn(x) for x in batch]
+    return results, time.perf_counter() - start
+
+def imap_batches(
+        pool: Pool,
+        fn: Callable,
+        batches: Iterable[list],
+        max_in_flight: int,
+        on_busy: Callable[[float], None] | None = None,
+    ) -> Iterator[list]:
+    # like pool.imap over batches, but yields results in input order while keeping at most max_in_flight batches
+    # submitted at a time. pool.imap would instead consume the whole input upfront. if on_busy is given, it is
+    # called with the seconds a worker spent on every batch
+    pending = deque()
+    def collect() -> list:
+        if on_busy is None:
+            return pending.popleft().get()
+        results, seconds = pending.popleft().get()
+        on_busy(seconds)
+        return results
+
+    for batch in batches:
+        pending.append(pool.apply_async(process_batch if on_busy is None else process_batch_timed, (fn, batch)))
+        if len(pending) >= max_in_flight:
+            yield collect()
+    while pending:
+        yield collect()
+
+class Pipeline:
+    # runs read -> parse -> write as overlapping stages: a reader thread fills a bounded queue of batches, the pool
+    # parses them, and a writer thread drains a bounded queue of results. a slow writer therefore blocks the parsers
+    # (and in turn the reader) instead of letting results pile up in memory
+    def __init__(
+            self,
+            pool: Pool,
+            fn: Callable,
+            batches: Iterable[list],
+            sink: Callable[[list], None],
+            max_in_flight: int,
+            queue_size: int,
+            on_busy: Callable[[float], None] | None = None,
+        ):
+        self.pool = pool
+        self.fn = fn
+        self.batches = batches
+        self.sink = sink
+        self.max_in_flight = max_in_flight
+        self.on_busy = on_busy
+
+        self.read_queue = Queue(maxsize=queue_size)
+        self.write_queue = Queue(maxsize=queue_size)
+        self.num_submitted = 0
+        self.num_collected = 0
+        self.error = None
+
+        self.depth_sums = {"read": 0, "parse": 0, "write": 0}
+        self.num_depth_samples = 0
+        self.busy_seconds = 0.
+
+    def get_queue_depths(self) -> dict[str, int]:
+        # read: batches waiting to be parsed, parse: batches in the pool, write: parsed batches waiting to be written
+        return {
+            "read": self.read_queue.qsize(),
+            "parse": self.num_submitted - self.num_collected,
+            "write": self.write_queue.qsize(),
+        }
+    
+    def get_mean_queue_depths(self) -> dict[str, float]:
+        return {k: v / max(self.num_depth_samples, 1) for k, v in self.depth_sums.items()}
+
+    def _add_busy_seconds(self, seconds: float):
+        self.busy_seconds += seconds
+        if self.on_busy is not None:
+            self.on_busy(seconds)
+
+    def _read(self):
+        try:
+            for batch in self.batches:
+                self.read_queue.put(batch)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.read_queue.put(_DONE)
+
+    def _iter_read_queue(self) -> Iterator[list]:
+        while (batch := self.read_queue.get()) is not _DONE and self.error is None:
+            self.num_submitted += 1
+            yield batch
+
+    def _write(self, pbar: tqdm):
+        last_report = 0.
+        while (results := self.write_queue.get()) is not _DONE:
+            if self.error is not None:
+                continue    # keep draining, so that the parse stage never blocks on a dead writer
+            try:
+                self.sink(results)
+            except BaseException as e:
+                self.error = e
+                continue
+            
+            pbar.update(len(results))
+            if time.monotonic() - last_report >= REPORT_INTERVAL_SECONDS:
+                pbar.set_postfix(self.get_queue_depths())
+                last_report = time.monotonic()
+
+    def run(self, progress: bool = True):
+        with tqdm(desc="Written", unit=" lines", position=1, disable=not progress) as pbar:
+            reader = Thread(target=self._read, daemon=True)
+            writer = Thread(target=self._write, args=(pbar,), daemon=True)
+            reader.start()
+            writer.start()
+
+            try:
+                for results in imap_batches(
+                        self.pool, self.fn, self._iter_read_queue(), self.max_in_flight, self._add_busy_seconds,
+                    ):
+                    self.num_collected += 1
+                    for k, v in self.get_queue_depths().items():
+                        self.depth_sums[k] += v
+                    self.num_depth_samples += 1
+                    self.write_queue.put(results)
+            finally:
+                self.write_queue.put(_DONE)
+                writer.join()
+
+        if self.error is not None:
+            raise self.error
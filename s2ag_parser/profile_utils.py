@@ -0,0 +1,81 @@
+import heapq
+from time import perf_counter
+
+class PaperProfile:
+    # wall time per stage of parsing one paper, and features of the paper that explain it. the parser only touches
+    # a profile if it is given one, so parsing without one costs nothing extra
+    __slots__ = ("corpusid", "stage2seconds", "features", "last")
+
+    def __init__(self):
+        self.corpusid = None
+        self.stage2seconds = {}
+        self.features = {}
+        self.last = perf_counter()
+
+    def lap(self, stage: str):
+        # charge the time since the previous lap (or since the profile was created) to stage
+        now = perf_counter()
+        self.stage2seconds[stage] = self.stage2seconds.get(stage, 0.) + now - self.last
+        self.last = now
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.stage2seconds.values())
+
+class ProfileAggregator:
+    # stage times summed over papers, plus the top_n slowest papers. aggregators are small and picklable, so every
+    # worker keeps its own and the parent merges them
+    def __init__(self, top_n: int = 10):
+        self.top_n = top_n
+        self.num_papers = 0
+        self.stage2seconds = {}
+        self.slowest = []       # min-heap of (seconds, corpusid, stage2seconds, features)
+
+    def add(self, profile: PaperProfile):
+        self.num_papers += 1
+        for stage, seconds in profile.stage2seconds.items():
+            self.stage2seconds[stage] = self.stage2seconds.get(stage, 0.) + seconds
+        self.push((profile.total_seconds, profile.corpusid, profile.stage2seconds, profile.features))
+
+    def push(self, entry: tuple):
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, entry)
+        elif entry[:2] > self.slowest[0][:2]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other: "ProfileAggregator"):
+        self.num_papers += other.num_papers
+        for stage, seconds in other.stage2seconds.items():
+            self.stage2seconds[stage] = self.stage2seconds.get(stage, 0.) + seconds
+        for entry in other.slowest:
+            self.push(entry)
+
+    def get_slowest(self) -> list[dict]:
+        return [
+            {"corpusid": corpusid, "seconds": seconds, "stage2seconds": stage2seconds, "features": features}
+            for seconds, corpusid, stage2seconds, features in sorted(self.slowest, key=lambda x: x[:2], reverse=True)
+        ]
+
+    def report(self) -> str:
+        total_seconds = sum(self.stage2seconds.values())
+        lines = [f"Stage times over {self.num_papers} papers ({total_seconds:.2f}s in total):"]
+        for stage, seconds in sorted(self.stage2seconds.items(), key=lambda x: x[1], reverse=True):
+            lines.append(
+                f"  {stage:<34}{seconds:>10.2f}s {seconds / max(total_seconds, 1e-12):>7.1%}"
+                f"{seconds / max(self.num_papers, 1) * 1e6:>12.1f}us per paper"
+            )
+
+        lines.append(f"Slowest {len(self.slowest)} papers:")
+        for paper in self.get_slowest():
+            slowest_stage = max(paper["stage2seconds"], key=paper["stage2seconds"].get, default=None)
+            if slowest_stage is None:
+                continue
+            features = ", ".join(f"{k}={v}" for k, v in paper["features"].items())
+            lines.append(
+                f"  corpusid={paper['corpusid']}: {paper['seconds'] * 1e3:.1f}ms "
+                f"(mostly {slowest_stage}: {paper['stage2seconds'][slowest_stage] * 1e3:.1f}ms); {features}"
+            )
+        return "\n".join(lines)
+
+def get_annotation_counts(annotations: dict) -> dict[str, int]:
+    return {f"num_{key}": len(_annotations) for key, _annotations in annotations.items()}
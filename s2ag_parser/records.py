@@ -0,0 +1,144 @@
+from dataclasses import dataclass, field
+
+# lightweight, slotted counterparts of the schemas in s2ag_parser.schemas. the build_* steps in s2orc_utils create
+# and mutate these while a paper is being parsed, and the result is converted to the schemas only once, at the end.
+# to_dict returns the same dict (with the same key order) as model_dump on the corresponding schema
+
+@dataclass(slots=True)
+class Span:
+    start: int
+    end: int
+
+    @classmethod
+    def from_annotation(cls, annotation: dict) -> "Span":
+        return cls(start=annotation["start"], end=annotation["end"])
+
+    def to_dict(self) -> dict:
+        return {"start": self.start, "end": self.end}
+
+def span_to_dict(span: Span | None) -> dict | None:
+    return None if span is None else span.to_dict()
+
+@dataclass(slots=True)
+class TextSpan:
+    text: str
+    original_span: Span | None
+
+    def to_dict(self) -> dict:
+        return {"text": self.text, "original_span": span_to_dict(self.original_span)}
+
+@dataclass(slots=True)
+class BibliographyEntry:
+    bibliography_id: int | None
+    corpusid: int | None
+    text: str
+    original_span: Span | None
+    original_id: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "text": self.text,
+            "original_span": span_to_dict(self.original_span),
+            "bibliography_id": self.bibliography_id,
+            "corpusid": self.corpusid,
+        }
+
+@dataclass(slots=True)
+class ReferenceMarker:
+    referenced_id: int | tuple[int, ...] | None
+    reference_marker_type: str
+    text: str
+    original_span: Span | None
+    relative_span: Span | None
+
+    def to_dict(self) -> dict:
+        return {
+            "text": self.text,
+            "original_span": span_to_dict(self.original_span),
+            "referenced_id": self.referenced_id,
+            "reference_marker_type": self.reference_marker_type,
+            "relative_span": span_to_dict(self.relative_span),
+        }
+
+@dataclass(slots=True)
+class Paragraph:
+    content_id: tuple[int, ...] | None
+    text: str
+    original_span: Span | None
+    reference_markers: list[ReferenceMarker] = field(default_factory=list)
+    content_type: str = "paragraph"
+
+    def to_dict(self) -> dict:
+        return {
+            "text": self.text,
+            "original_span": span_to_dict(self.original_span),
+            "content_id": self.content_id,
+            "content_type": self.content_type,
+            "reference_markers": [marker.to_dict() for marker in self.reference_markers],
+        }
+
+@dataclass(slots=True)
+class Formula:
+    content_id: tuple[int, ...] | None
+    text: str
+    original_span: Span | None
+    original_id: str | None = None
+    content_type: str = "formula"
+
+    def to_dict(self) -> dict:
+        return {
+            "text": self.text,
+            "original_span": span_to_dict(self.original_span),
+            "content_id": self.content_id,
+            "content_type": self.content_type,
+        }
+
+@dataclass(slots=True)
+class Infographic:
+    content_id: tuple[int, ...] | None
+    content_type: str   # figure or table
+    header: TextSpan
+    caption: TextSpan
+    text: str
+    original_span: Span | None
+    original_id: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "text": self.text,
+            "original_span": span_to_dict(self.original_span),
+            "content_id": self.content_id,
+            "content_type": self.content_type,
+            "header": self.header.to_dict(),
+            "caption": self.caption.to_dict(),
+        }
+
+@dataclass(slots=True)
+class Section:
+    content_id: tuple[int, ...] | None
+    section_level: tuple[str, ...]
+    header: TextSpan
+    contents: list["Paragraph | Formula | Infographic | Section"] = field(default_factory=list)
+    content_type: str = "section"
+
+    def to_dict(self) -> dict:
+        return {
+            "content_id": self.content_id,
+            "content_type": self.content_type,
+            "section_level": self.section_level,
+            "header": self.header.to_dict(),
+            "contents": [content.to_dict() for content in self.contents],
+        }
+
+@dataclass(slots=True)
+class S2ORC:
+    corpusid: int
+    contents: list[Section] = field(default_factory=list)
+    bibliography: list[BibliographyEntry] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "corpusid": self.corpusid,
+            "contents": [section.to_dict() for section in self.contents],
+            "bibliography": [entry.to_dict() for entry in self.bibliography],
+        }
@@ -1,9 +1,39 @@
 import ast
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from itertools import accumulate
+import json
 import regex as re
 
+from s2ag_parser.interval_utils import IntervalIndex
+from s2ag_parser.profile_utils import PaperProfile, get_annotation_counts
+from s2ag_parser.records import (
+    BibliographyEntry, 
+    Formula, 
+    Infographic, 
+    Paragraph, 
+    ReferenceMarker, 
+    S2ORC, 
+    Section, 
+    Span, 
+    TextSpan,
+)
 from s2ag_parser.schemas import *
 
+def _raise_on_constant(constant: str):
+    raise ValueError(f"Unexpected constant {constant}")
+
+def decode_annotations(raw_annotations: str) -> list:
+    # annotations are JSON arrays stored as strings, and json.loads is much faster than building a python AST.
+    # json and literal_eval only disagree on escapes, on true/false/null and on NaN/Infinity, so those payloads
+    # (which are rare) still go through literal_eval to keep the output exactly as before
+    if "\\" in raw_annotations or "true" in raw_annotations or "false" in raw_annotations or "null" in raw_annotations:
+        return ast.literal_eval(raw_annotations)
+    try:
+        return json.loads(raw_annotations, parse_constant=_raise_on_constant)
+    except ValueError:
+        return ast.literal_eval(raw_annotations)
+
 def sanitize_annotations(annotations: dict, text_len: int) -> dict:
     out = {}
     for key, _annotations in annotations.items():
@@ -15,56 +45,42 @@ def sanitize_annotations(annotations: dict, text_len: int) -> dict:
         out[key] = _annotations
         
         try:
-            # literal eval all annotations for easier access later on
-            _annotations_new = ast.literal_eval(_annotations)
+            # decode all annotations for easier access later on
+            _annotations_new = decode_annotations(_annotations)
             assert isinstance(_annotations_new, list)
             out[key] = _annotations_new
             
-            if isinstance(_annotations_new, dict):
-                    _annotations_new["start"] = int(_annotations_new["start"])
-                    _annotations_new["end"] = int(_annotations_new["end"])
-            elif isinstance(_annotations_new, list):
-                for _ in _annotations_new:
-                    _["start"], _["end"] = int(_["start"]), int(_["end"])
-            out[key] = _annotations_new
+            for _ in _annotations_new:
+                _["start"], _["end"] = int(_["start"]), int(_["end"])
         except:
-            print(f"Unable to literal eval {key=} annotations")
+            print(f"Unable to decode {key=} annotations")
 
         try:
-            # deduplicate and keep valid annotations only, i.e. where 0 <= start < end <= len(text)
+            # in a single pass over the sorted annotations: keep valid annotations only, i.e. where
+            # 0 <= start < end <= len(text), deduplicate them, and merge overlapping ones
             _annotations_new = []
             seen_idxs = set()
-            for ann in out[key]:
-                idxs = (ann["start"], ann["end"])
-                if idxs not in seen_idxs and 0 <= idxs[0] < idxs[1] <= text_len:
-                    _annotations_new.append(ann)
-                    seen_idxs.add(idxs)
+            for curr in sorted(out[key], key=lambda _: _["start"]):
+                idxs = (curr["start"], curr["end"])
+                if idxs in seen_idxs or not 0 <= idxs[0] < idxs[1] <= text_len:
+                    continue
+                seen_idxs.add(idxs)
 
-            _annotations_new.sort(key=lambda _: _["start"])
+                prev = _annotations_new[-1] if _annotations_new else None
+                if prev is not None and curr["start"] < prev["end"]:
+                    prev["end"] = max(prev["end"], curr["end"])
+
+                    for k, v in curr.get("attributes", {}).items():
+                        if k not in prev:
+                            prev[k] = v
+                else:
+                    _annotations_new.append(curr)
             out[key] = _annotations_new
         except:
-            print(f"Unable to deduplicate {key=} annotations")
-        
-        try:
-            # merge overlapping annotations
-            if len(out[key]) > 1:
-                _annotations_new = [out[key][0]]
-                for curr in out[key][1:]:
-                    prev = _annotations_new[-1]
-                    if curr["start"] < prev["end"]:
-                        prev["end"] = max(prev["end"], curr["end"])
-                        
-                        for k, v in curr.get("attributes", {}).items():
-                            if k not in prev:
-                                prev[k] = v
-                    else:
-                        _annotations_new.append(curr)
-                out[key] = _annotations_new
-        except:
-            print(f"Unable to merge overlapping {key=} annotations")
+            print(f"Unable to deduplicate and merge {key=} annotations")
     return out
 
-def build_bibliography(annotations: dict, raw_text: str, original2new_id: dict) -> list[BibliographyEntrySchema]:
+def build_bibliography(annotations: dict, raw_text: str, original2new_id: dict) -> list[BibliographyEntry]:
     bibliography = []
     bibliography_annotations = sorted(
         annotations.get("bibentry", []), key = lambda x: x["start"],
@@ -78,11 +94,11 @@ def build_bibliography(annotations: dict, raw_text: str, original2new_id: dict)
 
         new_id_i = i
         original_id_i = ann_i.get("attributes", {}).get("id")
-        bibliography.append(BibliographyEntrySchema(
+        bibliography.append(BibliographyEntry(
             bibliography_id=new_id_i,
             corpusid = corpusid,
             text = raw_text[ann_i["start"]:ann_i["end"]],
-            original_span = SpanSchema(**ann_i),
+            original_span = Span.from_annotation(ann_i),
             original_id = original_id_i,
         ))
         original2new_id[original_id_i] = new_id_i
@@ -113,19 +129,8 @@ def build_leaf_content(
         original2new_id: dict,
     ) -> tuple[list, list, set]:
 
-    def find_overlaps(_annotations: list[dict]) -> dict:
-        overlaps = defaultdict(list)
-        temp = [(i, x["start"], x["end"], x["key"]) for i, x in enumerate(_annotations)]
-        for i, (idx1, start1, end1, key1) in enumerate(temp):
-            for idx2, start2, end2, key2 in temp[i+1:]:
-                if start2 < end1:
-                    overlaps[idx1, key1].append((idx2, key2))
-                    overlaps[idx2, key2].append((idx1, key1))
-                else:
-                    break
-        return overlaps
-    
-    overlaps = find_overlaps(content_annotations)
+    # content annotations are sorted by start, so positions in the index are positions in content_annotations
+    index = IntervalIndex([(x["start"], x["end"]) for x in content_annotations])
 
     infographics = []
     formulas = []
@@ -134,39 +139,41 @@ def build_leaf_content(
         content_id = (i,)     # this will be overwritten in a later step
         key_i = ann_i["key"]
         text_i = raw_text[ann_i["start"]:ann_i["end"]]
-        span_i = SpanSchema(**ann_i)
+        span_i = Span.from_annotation(ann_i)
         original_id_i = ann_i.get("attributes", {}).get("id")
 
         if key_i in ["figure", "table"]:
-            overlaps_with_ann_i = overlaps[i, key_i]
+            overlaps_with_ann_i = [
+                (j, content_annotations[j]["key"]) for j in index.overlapping(ann_i["start"], ann_i["end"]) if j != i
+            ]
 
             # identify the overlapping annotation that is marked as sectionheader, then extract the header
             try:
                 j = [j for j, key_j in overlaps_with_ann_i if key_j == "sectionheader"][0]
                 ann_j = content_annotations[j]
 
-                header = TextSpanSchema(
+                header = TextSpan(
                     text=raw_text[ann_j["start"]:ann_j["end"]], 
-                    original_span=SpanSchema(**ann_j),
+                    original_span=Span.from_annotation(ann_j),
                 )
                 done_idxs.add(j)
             except:
-                header = TextSpanSchema(text="", original_span=None)
+                header = TextSpan(text="", original_span=None)
             
             # identify the overlapping annotation that is marked as figurecaption, then extract the caption
             try:
                 j = [j for j, key_j in overlaps_with_ann_i if key_j == "figurecaption"][0]
                 ann_j = content_annotations[j]
 
-                caption = TextSpanSchema(
+                caption = TextSpan(
                     text=raw_text[ann_j["start"]:ann_j["end"]], 
-                    original_span=SpanSchema(**ann_j),
+                    original_span=Span.from_annotation(ann_j),
                 )
                 done_idxs.add(j)
             except:
-                caption = TextSpanSchema(text="", original_span=None)
+                caption = TextSpan(text="", original_span=None)
 
-            infographics.append(InfographicSchema(
+            infographics.append(Infographic(
                 content_id = content_id,
                 content_type = key_i,
                 header = header,
@@ -177,7 +184,7 @@ def build_leaf_content(
             ))
 
         elif key_i == "formula":
-            formulas.append(FormulaSchema(
+            formulas.append(Formula(
                 content_id = content_id,
                 content_type = key_i,
                 text = text_i,
@@ -198,7 +205,7 @@ def build_leaf_content(
     
     return infographics, formulas, done_idxs
 
-def build_reference_markers(annotations: dict, raw_text: str, original2new_id: dict) -> list[ReferenceMarkerSchema]:
+def build_reference_markers(annotations: dict, raw_text: str, original2new_id: dict) -> list[ReferenceMarker]:
     reference_markers = []
     for reference_marker_type in allowed_reference_marker_types:
         for ann in annotations[reference_marker_type]:
@@ -206,11 +213,11 @@ def build_reference_markers(annotations: dict, raw_text: str, original2new_id: d
             referenced_original_id = ann.get("attributes", {}).get("ref_id")
             referenced_id = original2new_id.get(referenced_original_id)
 
-            reference_markers.append(ReferenceMarkerSchema(
+            reference_markers.append(ReferenceMarker(
                 referenced_id = referenced_id,
                 reference_marker_type = reference_marker_type,
                 text = raw_text[ann["start"]:ann["end"]],
-                original_span = SpanSchema(**ann),
+                original_span = Span.from_annotation(ann),
                 relative_span = None,   # just for now, because we have not figured out where each reference marker belongs
             ))
     return reference_markers
@@ -218,17 +225,19 @@ def build_reference_markers(annotations: dict, raw_text: str, original2new_id: d
 def build_paragraphs(
         content_annotations: list[dict], 
         raw_text: str, 
-        reference_markers: list[ReferenceMarkerSchema], 
+        reference_markers: list[ReferenceMarker], 
         done_idxs: set[int],
-    ) -> tuple[list[ParagraphSchema], set[int]]:
+    ) -> tuple[list[Paragraph], set[int]]:
+    marker_index = IntervalIndex([(m.original_span.start, m.original_span.end) for m in reference_markers])
+
     paragraphs = []
     for i, ann_i in enumerate(content_annotations):
         if i in done_idxs or ann_i["key"] != "paragraph":
             continue
         
         # construct paragraph
-        span_i = SpanSchema(**ann_i)
-        paragraph = ParagraphSchema(
+        span_i = Span.from_annotation(ann_i)
+        paragraph = Paragraph(
             content_id = (i,),
             content_type = ann_i["key"],
             text = raw_text[ann_i["start"]:ann_i["end"]],
@@ -237,14 +246,14 @@ def build_paragraphs(
         )
 
         # identify the reference markers that belong to this paragraph
-        for reference_marker in reference_markers:
+        for j in marker_index.contained_in(span_i.start, span_i.end):
+            reference_marker = reference_markers[j]
             span_j = reference_marker.original_span
-            if (span_i.start <= span_j.start and span_j.end <= span_i.end):
-                reference_marker.relative_span = SpanSchema(
-                    start = span_j.start - span_i.start,
-                    end = span_j.end - span_i.start,
-                )
-                paragraph.reference_markers.append(reference_marker)
+            reference_marker.relative_span = Span(
+                start = span_j.start - span_i.start,
+                end = span_j.end - span_i.start,
+            )
+            paragraph.reference_markers.append(reference_marker)
 
         paragraphs.append(paragraph)
 
@@ -268,14 +277,14 @@ def build_sections(
         content_annotations: list[dict], 
         raw_text: str, 
         done_idxs: set[int],
-    ) -> tuple[list[SectionSchema], set[int]]:
+    ) -> tuple[list[Section], set[int]]:
     sections = []
     depth2section_levels = defaultdict(set)
     for i, ann_i in enumerate(content_annotations):
         if i in done_idxs or ann_i["key"] != "sectionheader":
             continue
         
-        span_i = SpanSchema(**ann_i)
+        span_i = Span.from_annotation(ann_i)
         text_i = raw_text[span_i.start:span_i.end]
         if sections and sections[-1].header.text == text_i:
             done_idxs.add(i)
@@ -315,11 +324,11 @@ def build_sections(
         if depth > 1 and section_level[:-1] not in depth2section_levels[depth-1]:
             # insert parent section, with start/end being just the start of span_i
             parent_section_level = section_level[:-1]
-            header = TextSpanSchema(
+            header = TextSpan(
                 text="", 
-                original_span=SpanSchema(start=span_i.start, end=span_i.start),
+                original_span=Span(start=span_i.start, end=span_i.start),
             )
-            sections.append(SectionSchema(
+            sections.append(Section(
                 content_id = None,
                 content_type = "section",
                 section_level = parent_section_level,
@@ -327,11 +336,11 @@ def build_sections(
                 contents = [],
             ))
             depth2section_levels[depth-1].add(parent_section_level)
-        sections.append(SectionSchema(
+        sections.append(Section(
             content_id = (i,),
             content_type = "section",
             section_level = section_level,
-            header = TextSpanSchema(text=text_i, original_span=span_i),
+            header = TextSpan(text=text_i, original_span=span_i),
             contents = [],   # empty for now
         ))
         done_idxs.add(i)
@@ -339,21 +348,24 @@ def build_sections(
     return sections, done_idxs
 
 def assign_leaf_content_to_sections(
-        sections: list[SectionSchema], 
-        leaf_text_contents: list[ParagraphSchema, FormulaSchema], 
-        infographics: list[InfographicSchema],
-    ) -> list[SectionSchema]:
+        sections: list[Section], 
+        leaf_text_contents: list[Paragraph, Formula], 
+        infographics: list[Infographic],
+    ) -> list[Section]:
 
-    dummy_section = SectionSchema(
+    dummy_section = Section(
         content_id = (-1,),
         content_type = "section",
         section_level = ("",),
-        header = TextSpanSchema(
+        header = TextSpan(
             text="[[Dummy First Section]]", 
-            original_span = SpanSchema(start=0, end=0),  # rubbish values, just for now
+            original_span = Span(start=0, end=0),  # rubbish values, just for now
         ),
         contents = [],    
     )
+    # a content belongs to the last section before the first header that does not end before the content starts.
+    # the running max of header ends is non-decreasing, so that first header can be found by bisection
+    max_header_ends = list(accumulate((section.header.original_span.end for section in sections), max))
     for leaf_content in leaf_text_contents:
         # if content ends before first section header, add to dummy section
         if not sections or leaf_content.original_span.end < sections[0].header.original_span.start:
@@ -361,54 +373,48 @@ def assign_leaf_content_to_sections(
             continue
 
         # add content to most recent section
-        parent_section = None
-        for section in sections:
-            if section.header.original_span.end < leaf_content.original_span.start:
-                parent_section = section
-            else:
-                break
-        if parent_section:
-            parent_section.contents.append(leaf_content)
+        num_before = bisect_left(max_header_ends, leaf_content.original_span.start)
+        if num_before:
+            sections[num_before-1].contents.append(leaf_content)
+
+    # map each referenced id to its first referencing paragraph, as (section idx, position of the next paragraph
+    # in the section, or None if the referencing paragraph is the final paragraph of the section)
+    referenced_id2slot = {}
+    for section_idx, section in enumerate(sections):
+        paragraph_idxs = [i for i, content in enumerate(section.contents) if content.content_type == "paragraph"]
+        for i, next_i in zip(paragraph_idxs, paragraph_idxs[1:] + [None]):
+            for marker in section.contents[i].reference_markers:
+                referenced_id2slot.setdefault(marker.referenced_id, (section_idx, next_i))
 
     # add infographics before the paragraph following the one that references it for the first time
     # if referencing paragraph is final paragraph of section, then add to end of section
+    section_idx2slot2infographics = defaultdict(lambda: defaultdict(list))
     misc_infographics = []
     for infographic in infographics:
-        inserted = False
-        for section in sections:
-            for i, content in enumerate(section.contents):
-                if content.content_type != "paragraph":
-                    continue
-                    
-                if infographic.content_id in [m.referenced_id for m in content.reference_markers]:
-                    insert_idx = None
-                    for j in range(i+1, len(section.contents)):
-                        if section.contents[j].content_type == "paragraph":
-                            insert_idx = j
-                            break
-                    
-                    if insert_idx:
-                        section.contents.insert(insert_idx, infographic)
-                    else:
-                        section.contents.append(infographic)
-                        
-                    inserted = True
-                    break
-
-            if inserted:
-                break
-
-        if not inserted:
+        slot = referenced_id2slot.get(infographic.content_id)
+        if slot is None:
             misc_infographics.append(infographic)
+        else:
+            section_idx, insert_idx = slot
+            section_idx2slot2infographics[section_idx][insert_idx].append(infographic)
+
+    for section_idx, slot2infographics in section_idx2slot2infographics.items():
+        section = sections[section_idx]
+        contents = []
+        for i, content in enumerate(section.contents):
+            contents += slot2infographics.get(i, [])
+            contents.append(content)
+        contents += slot2infographics.get(None, [])
+        section.contents = contents
 
     # create new section for infographics with no referencing paragraph
     if misc_infographics:
         i = misc_infographics[0].original_span.start
-        header = TextSpanSchema(
+        header = TextSpan(
             text = "[[Miscellaneous Infographics]]",
-            original_span = SpanSchema(start=i, end=i),
+            original_span = Span(start=i, end=i),
         )
-        sections.append(SectionSchema(
+        sections.append(Section(
             content_id = (len(sections),),
             content_type = "section",
             section_level = ("",), 
@@ -432,44 +438,42 @@ def is_prefix(prefix: list, full: list) -> bool:
         return False
     return prefix == full[:len(prefix)]
 
-def nest_sections(sections):
+def nest_sections(sections: list[Section]) -> list[Section]:
+    # the parent of a section is the most recent section whose level is a proper prefix of its level. when a
+    # section is nested under its parent, the top-level sections that came after the parent are moved under it too.
+    # sections are tracked by their position in the input, so that every lookup is O(1) (or O(depth) for parents)
     nested_sections = []
-    stack = []
+    nested_idxs = []      # positions of nested_sections in the input, which are always increasing
+    level2last_idx = {}
 
     for curr_idx, curr in enumerate(sections):
         level = curr.section_level
-        parent = None
-        for p in reversed(stack):
-            if is_prefix(p.section_level, level):
-                parent = p
-                break
-
-        if parent:
-            sibling_content_ids = [
-                s.content_id for s in parent.contents
-                if s.content_type == "section"
-            ]
+        parent_idx = max(
+            (level2last_idx.get(level[:depth], -1) for depth in range(1, len(level))), 
+            default=-1,
+        )
 
-            parent_idx = sections.index(p)
-            for prev in sections[parent_idx+1:curr_idx]:
-                if prev.content_id not in sibling_content_ids:
-                    
-                    for item_idx, item in enumerate(nested_sections):
-                        if item.content_id == prev.content_id:
-                            nested_sections.pop(item_idx)
-                            parent.contents.append(item)
+        if parent_idx >= 0:
+            parent = sections[parent_idx]
 
-                            break
+            # the top-level sections after the parent form a suffix of nested_sections
+            num_kept = bisect_right(nested_idxs, parent_idx)
+            parent.contents += nested_sections[num_kept:]
+            del nested_sections[num_kept:], nested_idxs[num_kept:]
 
             parent.contents.append(curr)
         else:
             nested_sections.append(curr)
+            nested_idxs.append(curr_idx)
 
-        stack.append(curr)
+        level2last_idx[level] = curr_idx
     return nested_sections
 
-def reassign_content_ids(sections: list[SectionSchema]):
+def reassign_content_ids(sections: list[Section]):
+    # renumber contents in a single traversal, collecting the figure/table reference markers along the way. the
+    # markers are remapped afterwards, since they may reference contents that come later in the traversal
     old2new_content_id = {}
+    markers_to_remap = []
 
     def content_updater(contents, _parent_id):
         for i, content in enumerate(contents):
@@ -477,52 +481,86 @@ def reassign_content_ids(sections: list[SectionSchema]):
             old2new_content_id[content.content_id] = new_content_id
             content.content_id = new_content_id
 
-            if content.content_type == "section":
+            if content.content_type == "paragraph":
+                markers_to_remap.extend(
+                    marker for marker in content.reference_markers 
+                    if marker.reference_marker_type in ["figureref", "tableref"]
+                )
+            elif content.content_type == "section":
                 content_updater(content.contents, content.content_id)
 
     content_updater(sections, ())
 
-    def referenced_content_id_updater(contents):
-        for content in contents:
-            if content.content_type == "paragraph":
-                for marker in content.reference_markers:
-                    if marker.reference_marker_type in ["figureref", "tableref"]:
-                        marker.referenced_id = old2new_content_id.get(marker.referenced_id)
-            elif content.content_type == "section":
-                referenced_content_id_updater(content.contents)
+    for marker in markers_to_remap:
+        marker.referenced_id = old2new_content_id.get(marker.referenced_id)
 
-    referenced_content_id_updater(sections)
+def build_s2orc_record(raw_s2orc: dict, profile: PaperProfile | None = None) -> S2ORC:
+    # if a profile is given, the time of every stage and some features of the paper are recorded in it
+    if profile is not None:
+        profile.corpusid = raw_s2orc["corpusid"]
 
-def build_s2orc(raw_s2orc: dict) -> S2ORCSchema:
     # extract raw text of paper
     raw_text = raw_s2orc["content"]["text"] or ""
 
     # sanitize the annotations done by S2AG
     annotations = sanitize_annotations(raw_s2orc["content"]["annotations"].copy(), len(raw_text))
+    if profile is not None:
+        profile.lap("sanitize_annotations")
 
     # get bibliography, reference markers, and leaf contents
     original2new_id = {}
     bibliography = build_bibliography(annotations, raw_text, original2new_id)
+    if profile is not None:
+        profile.lap("build_bibliography")
     
     content_annotations = collect_content_annotations(annotations)
     infographics, formulas, done_idxs = build_leaf_content(content_annotations, raw_text, original2new_id)
+    if profile is not None:
+        profile.lap("build_leaf_content")
     reference_markers = build_reference_markers(annotations, raw_text, original2new_id)
+    if profile is not None:
+        profile.lap("build_reference_markers")
     paragraphs, done_idxs = build_paragraphs(content_annotations, raw_text, reference_markers, done_idxs)
 
     # arrange leaf contents (paragraphs and formulas) based on start position
     leaf_contents = paragraphs + formulas
     leaf_contents.sort(key = lambda x: x.original_span.start)
+    if profile is not None:
+        profile.lap("build_paragraphs")
 
     # now build sections, inserting parent sections as necessary along the way
     sections, done_idxs = build_sections(content_annotations, raw_text, done_idxs)
+    num_sections = len(sections)
+    if profile is not None:
+        profile.lap("build_sections")
     sections = assign_leaf_content_to_sections(sections, leaf_contents, infographics)
+    if profile is not None:
+        profile.lap("assign_leaf_content_to_sections")
     sections = nest_sections(sections)
+    if profile is not None:
+        profile.lap("nest_sections")
 
     # redefine all content_ids in a way that respects the section nesting
     reassign_content_ids(sections)
-
-    return S2ORCSchema(
+    if profile is not None:
+        profile.lap("reassign_content_ids")
+        profile.features = {
+            "text_length": len(raw_text),
+            **get_annotation_counts(annotations),
+            "num_sections": num_sections,
+            "num_reference_markers": len(reference_markers),
+        }
+
+    return S2ORC(
         corpusid = raw_s2orc["corpusid"],
         contents = sections,
         bibliography = bibliography,
-    )
\ No newline at end of file
+    )
+
+def build_s2orc(raw_s2orc: dict, profile: PaperProfile | None = None) -> S2ORCSchema:
+    # the whole paper is validated once here, rather than every span, marker and content as it is built
+    record = build_s2orc_record(raw_s2orc, profile)
+    s2orc = S2ORCSchema.model_validate(record.to_dict())
+    if profile is not None:
+        profile.lap("validate")
+    return s2orc
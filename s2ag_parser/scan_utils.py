@@ -0,0 +1,224 @@
+from functools import partial
+import json
+from multiprocessing import Pool
+import os
+from typing import Any, Callable, Iterator
+
+import numpy as np
+from tqdm import tqdm
+
+from s2ag_parser.datautils import (
+    get_bibliography,
+    get_corpusid,
+    get_text,
+    iter_contents,
+    iter_paragraphs,
+)
+from s2ag_parser.index_utils import OffsetIndexReader, get_index_paths, parse_corpusid
+from s2ag_parser.io_utils import get_part_range, iter_lines, read_manifest, split_byte_ranges
+from s2ag_parser.pool_utils import MAX_IN_FLIGHT_PER_WORKER, get_num_workers, imap_batches
+
+DEFAULT_SCAN_RANGE_SIZE = 16 * 1024 * 1024
+
+## Predicates and projections. they are module-level functions (bound with partial), so that they can be pickled
+
+def has_content_type(paper: dict, content_type: str) -> bool:
+    return next(iter_contents(paper, content_types=(content_type,)), None) is not None
+
+def cites(paper: dict, corpusid: int) -> bool:
+    return any(entry["corpusid"] == corpusid for entry in get_bibliography(paper))
+
+def contains_text(paper: dict, text: str) -> bool:
+    return any(text in get_text(paragraph) for _, paragraph in iter_paragraphs(paper))
+
+def match_all(paper: dict, predicates: list[Callable[[dict], bool]]) -> bool:
+    return all(predicate(paper) for predicate in predicates)
+
+def project_corpusid(paper: dict) -> dict:
+    return {"corpusid": get_corpusid(paper)}
+
+def project_bibliography(paper: dict) -> dict:
+    return {"corpusid": get_corpusid(paper), "bibliography": get_bibliography(paper)}
+
+def project_paragraph_text(paper: dict) -> dict:
+    return {"corpusid": get_corpusid(paper), "paragraphs": [get_text(p) for _, p in iter_paragraphs(paper)]}
+
+PROJECTIONS = {
+    "full": None,
+    "corpusid": project_corpusid,
+    "bibliography": project_bibliography,
+    "paragraph_text": project_paragraph_text,
+}
+
+## Needles for the substring prefilter. a needle must be in the line of every paper that can match, because the
+## prefilter drops lines without it before they are decoded
+
+def get_json_needle(text: str) -> bytes:
+    # text as it appears inside a JSON string written with json.dumps defaults
+    return json.dumps(text)[1:-1].encode("utf-8")
+
+def get_content_type_needle(content_type: str) -> bytes:
+    return f'"content_type": {json.dumps(content_type)}'.encode("utf-8")
+
+def get_corpusid_needle(corpusid: int) -> bytes:
+    return f'"corpusid": {corpusid}'.encode("utf-8")
+
+class ScanQuery:
+    # which papers match and what is kept of them. before a line is decoded, it is dropped if its corpusid is not
+    # one of corpusids, or if it does not contain all of needles; only the remaining lines are decoded and checked
+    # against predicate
+    def __init__(
+            self,
+            predicate: Callable[[dict], bool] | None = None,
+            projection: Callable[[dict], Any] | None = None,
+            needles: list[bytes] | None = None,
+            corpusids: list[int] | None = None,
+        ):
+        self.predicate = predicate
+        self.projection = projection
+        self.needles = needles or []
+        self.corpusids = None if corpusids is None else np.unique(np.asarray(corpusids, dtype=np.int64))
+
+    def has_corpusid(self, corpusid: int) -> bool:
+        i = np.searchsorted(self.corpusids, corpusid)
+        return i < len(self.corpusids) and self.corpusids[i] == corpusid
+
+    def prefilter(self, line: bytes) -> bool:
+        if self.corpusids is not None and not self.has_corpusid(parse_corpusid(line)):
+            return False
+        return all(needle in line for needle in self.needles)
+
+    def apply(self, line: bytes) -> tuple[bool, Any]:
+        # (whether the paper matches, its projection). without a projection, the paper is kept as its raw line, so
+        # that it does not have to be encoded again; without a predicate either, it is not even decoded
+        if self.predicate is None and self.projection is None:
+            return True, line
+        paper = json.loads(line)
+        if self.predicate is not None and not self.predicate(paper):
+            return False, None
+        return True, line if self.projection is None else self.projection(paper)
+
+# set once per worker by init_scan_worker, so that a large query (e.g. many corpusids) is only sent once per worker
+scan_query: ScanQuery | None = None
+
+def init_scan_worker(query: ScanQuery):
+    global scan_query
+    scan_query = query
+
+def scan_byte_range(task: tuple[str, int, int]) -> tuple[list[Any], dict[str, int]]:
+    filepath, start, end = task
+    matches = []
+    counts = {"num_lines": 0, "num_decoded": 0, "num_matches": 0}
+    for line in iter_lines(filepath, start, end, progress=False, decode=False):
+        counts["num_lines"] += 1
+        if not scan_query.prefilter(line):
+            continue
+        counts["num_decoded"] += 1
+        is_match, result = scan_query.apply(line)
+        if is_match:
+            matches.append(result)
+    counts["num_matches"] = len(matches)
+    return matches, counts
+
+def expand_input_paths(input_paths: list[str]) -> list[tuple[str, int, int]]:
+    # the (filepath, start, end) byte ranges to scan. manifests (see io_utils.write_manifest) stand for their parts,
+    # in order, which may be slices of a merged file; contiguous slices of the same file are scanned as one range
+    byte_ranges = []
+    for input_path in input_paths:
+        if input_path.endswith(".manifest.json"):
+            for filepath, start, end in map(get_part_range, read_manifest(input_path)):
+                if byte_ranges and byte_ranges[-1][0] == filepath and byte_ranges[-1][2] == start:
+                    byte_ranges[-1] = (filepath, byte_ranges[-1][1], end)
+                else:
+                    byte_ranges.append((filepath, start, end))
+        else:
+            byte_ranges.append((input_path, 0, os.path.getsize(input_path)))
+    return byte_ranges
+
+def lookup_indexed(filepaths: list[str], query: ScanQuery, counts: dict[str, int]) -> Iterator[Any]:
+    # with corpusids and an offset index for every file (see build_index.py), only the indexed lines are read, in
+    # file order, so those are the only lines counted as scanned. read_line drops the newline, which is put back so
+    # that raw lines come out as they are in the file
+    for filepath in filepaths:
+        with OffsetIndexReader(filepath) as reader:
+            _, offsets = reader.find_offsets(query.corpusids)
+            for offset in np.sort(offsets):
+                line = reader.read_line(int(offset)) + b"\n"
+                counts["num_lines"] += 1
+                if not all(needle in line for needle in query.needles):
+                    continue
+                counts["num_decoded"] += 1
+                is_match, result = query.apply(line)
+                if is_match:
+                    counts["num_matches"] += 1
+                    yield result
+
+def scan(
+        input_paths: list[str],
+        query: ScanQuery,
+        num_workers: int | None = None,
+        range_size: int = DEFAULT_SCAN_RANGE_SIZE,
+        counts: dict[str, int] | None = None,
+        progress: bool = True,
+    ) -> Iterator[Any]:
+    # yield the (projected) papers that match query, in file order, or their raw lines (bytes) if query has no
+    # projection. the files are split into byte ranges that are scanned in parallel, with at most
+    # MAX_IN_FLIGHT_PER_WORKER ranges per worker submitted ahead of the caller, so that unread matches do not pile
+    # up. the workers are stopped as soon as the caller stops iterating. if counts is given, it is updated with the
+    # number of lines scanned, decoded and matched
+    counts = {} if counts is None else counts
+    counts.update(num_lines=0, num_decoded=0, num_matches=0)
+    byte_ranges = expand_input_paths(input_paths)
+
+    # the offset index covers whole files, so it can only be used if every range is a whole file
+    if query.corpusids is not None and all(
+        start == 0 and end == os.path.getsize(filepath) and os.path.exists(get_index_paths(filepath)[0])
+        for filepath, start, end in byte_ranges
+    ):
+        yield from lookup_indexed([filepath for filepath, _, _ in byte_ranges], query, counts)
+        return
+
+    tasks = [
+        task 
+        for filepath, start, end in byte_ranges 
+        for task in split_byte_ranges(filepath, range_size, start, end)
+    ]
+    num_workers = get_num_workers(num_workers)
+    with Pool(num_workers, initializer=init_scan_worker, initargs=(query,)) as p, \
+        tqdm(total=sum(end - start for _, start, end in tasks), unit="B", unit_scale=True, disable=not progress) as pbar:
+        # every range is sent as a batch of one
+        results = imap_batches(p, scan_byte_range, ([task] for task in tasks), MAX_IN_FLIGHT_PER_WORKER * num_workers)
+        for (_, start, end), [(matches, task_counts)] in zip(tasks, results):
+            for k, v in task_counts.items():
+                counts[k] += v
+            pbar.update(end - start)
+            yield from matches
+
+def build_query(
+        corpusids: list[int] | None = None,
+        content_types: list[str] | None = None,
+        cited_corpusids: list[int] | None = None,
+        texts: list[str] | None = None,
+        predicate: Callable[[dict], bool] | None = None,
+        projection: Callable[[dict], Any] | None = None,
+    ) -> ScanQuery:
+    # a query for papers that match all of the given conditions, each with the needles that it implies
+    predicates, needles = [], []
+    for content_type in content_types or []:
+        predicates.append(partial(has_content_type, content_type=content_type))
+        needles.append(get_content_type_needle(content_type))
+    for corpusid in cited_corpusids or []:
+        predicates.append(partial(cites, corpusid=corpusid))
+        needles.append(get_corpusid_needle(corpusid))
+    for text in texts or []:
+        predicates.append(partial(contains_text, text=text))
+        needles.append(get_json_needle(text))
+    if predicate is not None:
+        predicates.append(predicate)
+
+    return ScanQuery(
+        predicate = partial(match_all, predicates=predicates) if predicates else None,
+        projection = projection,
+        needles = needles,
+        corpusids = corpusids,
+    )
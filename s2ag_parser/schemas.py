@@ -91,5 +91,11 @@ class MetadataSchema(BaseSchema):
     title: str | None
     year: int | None
 
+class AbstractSchema(BaseSchema):
+    abstract: str
+
+class MetadataWithAbstractSchema(AbstractSchema, MetadataSchema):
+    pass
+
 class PaperSchema(MetadataSchema, S2ORCSchema):
     pass
\ No newline at end of file
@@ -0,0 +1,75 @@
+import heapq
+from operator import itemgetter
+import os
+import shutil
+import tempfile
+from typing import Iterable, Iterator
+
+from s2ag_parser.index_utils import DEFAULT_MAX_MEMORY_BYTES, parse_corpusid
+
+LINE_OVERHEAD_BYTES = 100       # rough size of the python objects that hold one line and its key while sorting
+MAX_MERGE_FANIN = 128           # maximum number of runs that are open at once while merging
+
+def iter_keyed_lines(filepath: str) -> Iterator[tuple[int, bytes]]:
+    with open(filepath, "rb") as f:
+        for line in f:
+            yield parse_corpusid(line), line
+
+def write_lines(lines: Iterable[tuple[int, bytes]], filepath: str):
+    with open(filepath, "wb") as f_out:
+        for _, line in lines:
+            f_out.write(line)
+
+def merge_runs(run_paths: list[str], out_path: str):
+    # heapq.merge is stable, so equal corpusids keep the order of the runs, i.e. their order in the input file
+    write_lines(heapq.merge(*[iter_keyed_lines(run_path) for run_path in run_paths], key=itemgetter(0)), out_path)
+
+def external_sort(input_path: str, out_path: str, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES):
+    # sort the lines of a jsonl file by corpusid (stably) with bounded memory: sorted runs of at most
+    # max_memory_bytes are written to temporary files, and then merged in passes of at most MAX_MERGE_FANIN runs
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        run_paths = []
+        def write_run(lines: list[tuple[int, bytes]]):
+            lines.sort(key=itemgetter(0))
+            run_paths.append(os.path.join(tmp_dir, f"pass-0-run-{len(run_paths):05d}.jsonl"))
+            write_lines(lines, run_paths[-1])
+
+        lines, num_bytes = [], 0
+        for corpusid, line in iter_keyed_lines(input_path):
+            lines.append((corpusid, line))
+            num_bytes += len(line) + LINE_OVERHEAD_BYTES
+            if num_bytes >= max_memory_bytes:
+                write_run(lines)
+                lines, num_bytes = [], 0
+        if lines or not run_paths:
+            write_run(lines)
+
+        num_passes = 0
+        while len(run_paths) > MAX_MERGE_FANIN:
+            num_passes += 1
+            merged_run_paths = []
+            for i in range(0, len(run_paths), MAX_MERGE_FANIN):
+                merged_run_paths.append(os.path.join(tmp_dir, f"pass-{num_passes}-run-{len(merged_run_paths):05d}.jsonl"))
+                merge_runs(run_paths[i:i+MAX_MERGE_FANIN], merged_run_paths[-1])
+                for run_path in run_paths[i:i+MAX_MERGE_FANIN]:
+                    os.remove(run_path)
+            run_paths = merged_run_paths
+
+        if len(run_paths) == 1:
+            shutil.move(run_paths[0], out_path)
+        else:
+            merge_runs(run_paths, out_path)
+
+def merge_join(
+        left_lines: Iterable[tuple[int, bytes]],
+        right_lines: Iterable[tuple[int, bytes]],
+    ) -> Iterator[tuple[bytes, bytes | None]]:
+    # left join of two streams of (corpusid, line) that are both sorted by corpusid. every left line is yielded
+    # once, together with the first right line with the same corpusid (or None)
+    right_lines = iter(right_lines)
+    right = next(right_lines, None)
+    for left_corpusid, left_line in left_lines:
+        while right is not None and right[0] < left_corpusid:
+            right = next(right_lines, None)
+        yield left_line, right[1] if right is not None and right[0] == left_corpusid else None
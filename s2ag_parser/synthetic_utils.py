@@ -0,0 +1,142 @@
+from dataclasses import dataclass, replace
+import json
+import random
+
+WORDS = [
+    "the", "of", "and", "model", "results", "we", "data", "method", "show", "that", "in", "learning", "analysis",
+    "proposed", "performance", "network", "approach", "based", "using", "task", "error", "set", "training", "is",
+]
+
+@dataclass
+class SyntheticConfig:
+    # shape of the generated papers. lengths are in characters, and counts are per paper unless stated otherwise
+    num_sections: int = 10
+    section_depth: int = 3
+    paragraphs_per_section: int = 4
+    paragraph_length: int = 800
+    num_bibentries: int = 40
+    bibrefs_per_paragraph: int = 3
+    num_figures: int = 4
+    figure_length: int = 300
+    figure_overlap: float = 0.5     # fraction of figures whose header and caption overlap the figure itself
+    num_formulas: int = 4
+
+    def scaled(self, scale: int) -> "SyntheticConfig":
+        # the same paper shape with scale times as many sections, references and figures, to expose superlinear costs
+        return replace(
+            self,
+            num_sections = self.num_sections * scale,
+            num_bibentries = self.num_bibentries * scale,
+            num_figures = self.num_figures * scale,
+            num_formulas = self.num_formulas * scale,
+        )
+
+class TextBuilder:
+    # appends text and records the span of every annotated piece, the way S2AG annotates the raw text
+    def __init__(self, rnd: random.Random):
+        self.rnd = rnd
+        self.chunks = []
+        self.length = 0
+        self.annotations = {}
+
+    def add(self, text: str, key: str | None = None, attributes: dict | None = None) -> tuple[int, int]:
+        start = self.length
+        self.chunks.append(text)
+        self.length += len(text)
+        if key is not None:
+            self.annotate(key, start, self.length, attributes)
+        return start, self.length
+
+    def annotate(self, key: str, start: int, end: int, attributes: dict | None = None):
+        annotation = {"start": start, "end": end}
+        if attributes is not None:
+            annotation["attributes"] = attributes
+        self.annotations.setdefault(key, []).append(annotation)
+
+    def words(self, length: int) -> str:
+        text = ""
+        while len(text) < length:
+            text += self.rnd.choice(WORDS) + " "
+        return text[:length]
+
+def get_section_numbers(num_sections: int, depth: int) -> list[str]:
+    # numbered like a thesis, descending to the given depth before moving on: 1, 1.1, 1.1.1, 2, 2.1, 2.1.1, ...
+    numbers = []
+    counters = [0] * depth
+    for i in range(num_sections):
+        level = i % depth
+        counters[level] += 1
+        counters[level+1:] = [0] * (depth - level - 1)
+        numbers.append(".".join(str(n) for n in counters[:level+1]))
+    return numbers
+
+def generate_raw_s2orc(corpusid: int, config: SyntheticConfig, seed: int = 0) -> dict:
+    # a raw record in the shape of the S2ORC dataset: the full text, plus annotations stored as JSON strings
+    rnd = random.Random(seed * 1_000_003 + corpusid)
+    builder = TextBuilder(rnd)
+    bibliography_size = max(config.num_bibentries, 1)
+
+    figure_idxs = set(rnd.sample(
+        range(config.num_sections * config.paragraphs_per_section),
+        min(config.num_figures, config.num_sections * config.paragraphs_per_section),
+    ))
+    formula_idxs = set(rnd.sample(
+        range(config.num_sections * config.paragraphs_per_section),
+        min(config.num_formulas, config.num_sections * config.paragraphs_per_section),
+    ))
+    num_figures, num_formulas = 0, 0
+
+    for i, n in enumerate(get_section_numbers(config.num_sections, config.section_depth)):
+        builder.add(f"{n} {builder.words(30).strip().title()}", "sectionheader", {"n": n})
+        builder.add("\n")
+
+        for j in range(config.paragraphs_per_section):
+            # a paragraph with bibrefs (and the odd figure reference) at random positions
+            paragraph_start = builder.length
+            cuts = sorted(rnd.randrange(config.paragraph_length) for _ in range(config.bibrefs_per_paragraph))
+            for length in [b - a for a, b in zip([0] + cuts, cuts + [config.paragraph_length])]:
+                builder.add(builder.words(length))
+                bibentry_idx = rnd.randrange(bibliography_size)
+                builder.add(f"[{bibentry_idx + 1}]", "bibref", {"ref_id": f"b{bibentry_idx}"})
+            if num_figures:
+                figure_idx = rnd.randrange(num_figures)
+                builder.add(f" (Figure {figure_idx + 1})", "figureref", {"ref_id": f"fig_{figure_idx}"})
+            builder.annotate("paragraph", paragraph_start, builder.length)
+            builder.add("\n")
+
+            paragraph_idx = i * config.paragraphs_per_section + j
+            if paragraph_idx in formula_idxs:
+                builder.add(f"x_{num_formulas} = {builder.words(20)}", "formula", {"id": f"formula_{num_formulas}"})
+                builder.add("\n")
+                num_formulas += 1
+
+            if paragraph_idx in figure_idxs:
+                is_table = rnd.random() < 0.3
+                attributes = {"id": f"fig_{num_figures}"} | ({"type": "table"} if is_table else {})
+                label = f"{'Table' if is_table else 'Figure'} {num_figures + 1}"
+                if rnd.random() < config.figure_overlap:
+                    # header and caption annotated inside the figure, as S2AG often does
+                    start, _ = builder.add(f"{label}: ", "sectionheader")
+                    builder.add(builder.words(config.figure_length // 3), "figurecaption")
+                    builder.add(builder.words(config.figure_length - config.figure_length // 3 - len(label) - 2))
+                    builder.annotate("figure", start, builder.length, attributes)
+                else:
+                    builder.add(f"{label}: {builder.words(config.figure_length)}", "figure", attributes)
+                builder.add("\n")
+                num_figures += 1
+
+    builder.add("References\n")
+    for k in range(config.num_bibentries):
+        # unmatched entries have no matched_paper_id at all
+        attributes = {"id": f"b{k}"} | ({"matched_paper_id": rnd.randrange(1, 1 << 28)} if rnd.random() < 0.7 else {})
+        builder.add(f"[{k + 1}] {builder.words(120)}", "bibentry", attributes)
+        builder.add("\n")
+
+    annotations = {
+        key: json.dumps(builder.annotations[key]) if key in builder.annotations else None
+        for key in [
+            "sectionheader", "paragraph", "figure", "figurecaption", "formula", "table",
+            "bibentry", "bibref", "figureref", "tableref",
+        ]
+    }
+    return {"corpusid": corpusid, "content": {"text": "".join(builder.chunks), "annotations": annotations}}
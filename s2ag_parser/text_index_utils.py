@@ -0,0 +1,442 @@
+from array import array
+import heapq
+from itertools import groupby
+import json
+import mmap
+from multiprocessing import Pool
+from operator import itemgetter
+import os
+import re
+import struct
+import tempfile
+from typing import BinaryIO, Iterator
+import zlib
+
+import numpy as np
+from tqdm import tqdm
+
+from s2ag_parser.array_utils import IndptrAppender, NpyAppender
+from s2ag_parser.datautils import get_corpusid, get_text, iter_paragraphs
+from s2ag_parser.index_utils import APPEND_BUFFER_SIZE
+from s2ag_parser.io_utils import iter_lines, split_byte_ranges
+from s2ag_parser.pool_utils import get_num_workers
+from s2ag_parser.sort_utils import MAX_MERGE_FANIN
+
+DEFAULT_INDEX_RANGE_SIZE = 64 * 1024 * 1024
+META_FILENAME = "index.json"
+TOKEN_PATTERN = re.compile(r"\w+")
+CHUNK_HEADER = struct.Struct("<qII")    # base doc id, number of docs, size of the compressed payload
+RECORD_HEADER = struct.Struct("<II")    # size of the term, size of its postings
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# every paragraph is a doc, with doc ids in the order of the paragraphs in the input files. the index is stored as
+#   doc_corpusid.npy, doc_content_id.npy (+ _indptr), doc_length.npy: the paper, content id and number of tokens of
+#       every doc
+#   term_text.npy (+ _indptr): the utf-8 bytes of all terms, sorted
+#   term_df.npy: the number of docs that contain each term
+#   postings.bin: the postings of term i are bytes term_postings_indptr[i] to term_postings_indptr[i+1]
+#
+# postings are a sequence of chunks, one per run that the term occurred in. a chunk is a CHUNK_HEADER followed by a
+# zlib-compressed array of uint32: the gaps between the doc ids (the first one counted from the base doc id), the
+# number of occurrences in each doc, and the gaps between the positions of the occurrences within each doc (the first
+# one counted from 0). runs are merged without decompressing anything, by only rewriting the base doc ids
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+## Postings
+
+def get_gaps(
+        token_ranks: np.ndarray,
+        doc_ids: np.ndarray,
+        positions: np.ndarray,
+        num_terms: int,
+    ) -> dict[str, np.ndarray]:
+    # the arrays of the chunks of all terms at once, from the tokens sorted by (term rank, doc id, position). the
+    # doc-level arrays (doc_gaps, tfs) of term i are those between doc_bounds[i] and doc_bounds[i+1]
+    is_first = np.ones(len(token_ranks), dtype=bool)      # first occurrence of a term in a doc
+    is_first[1:] = (token_ranks[1:] != token_ranks[:-1]) | (doc_ids[1:] != doc_ids[:-1])
+    firsts = np.flatnonzero(is_first)
+    position_gaps = np.diff(positions, prepend=0)
+    position_gaps[firsts] = positions[firsts]
+
+    doc_ranks, docs = token_ranks[firsts], doc_ids[firsts]
+    doc_gaps = np.diff(docs, prepend=0)
+    is_first_doc = np.ones(len(docs), dtype=bool)         # first doc of a term
+    is_first_doc[1:] = doc_ranks[1:] != doc_ranks[:-1]
+    doc_gaps[is_first_doc] = docs[is_first_doc]
+    return {
+        "doc_gaps": doc_gaps.astype(np.uint32),
+        "tfs": np.diff(firsts, append=len(token_ranks)).astype(np.uint32),
+        "position_gaps": position_gaps.astype(np.uint32),
+        "doc_bounds": np.searchsorted(doc_ranks, np.arange(num_terms + 1)),
+    }
+
+def encode_postings(doc_gaps: np.ndarray, tfs: np.ndarray, position_gaps: np.ndarray) -> bytes:
+    # one chunk, from the uint32 arrays of a term (see get_gaps)
+    payload = zlib.compress(doc_gaps.tobytes() + tfs.tobytes() + position_gaps.tobytes())
+    return CHUNK_HEADER.pack(0, len(doc_gaps), len(payload)) + payload
+
+def iter_chunks(postings: bytes) -> Iterator[tuple[int, int, int, int]]:
+    # (offset, base doc id, number of docs, payload size) of every chunk
+    offset = 0
+    while offset < len(postings):
+        base_doc, num_docs, size = CHUNK_HEADER.unpack_from(postings, offset)
+        yield offset, base_doc, num_docs, size
+        offset += CHUNK_HEADER.size + size
+
+def rebase_postings(postings: bytes, doc_offset: int) -> bytes:
+    postings = bytearray(postings)
+    for offset, base_doc, num_docs, size in iter_chunks(postings):
+        CHUNK_HEADER.pack_into(postings, offset, base_doc + doc_offset, num_docs, size)
+    return bytes(postings)
+
+def count_docs(postings: bytes) -> int:
+    return sum(num_docs for _, _, num_docs, _ in iter_chunks(postings))
+
+def decode_postings(postings: bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (doc ids, number of occurrences in each doc, positions). the positions of docs[i] are
+    # positions[tf_offsets[i]:tf_offsets[i]+tfs[i]], where tf_offsets = np.cumsum(tfs) - tfs
+    docs, tfs, positions = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for offset, base_doc, num_docs, size in iter_chunks(postings):
+        start = offset + CHUNK_HEADER.size
+        values = np.frombuffer(zlib.decompress(postings[start:start+size]), dtype=np.uint32).astype(np.int64)
+        chunk_tfs, position_gaps = values[num_docs:2*num_docs], values[2*num_docs:]
+
+        # undo the position gaps with a running sum that restarts at every doc
+        sums = np.cumsum(position_gaps)
+        starts = np.cumsum(chunk_tfs) - chunk_tfs
+        docs.append(base_doc + np.cumsum(values[:num_docs]))
+        tfs.append(chunk_tfs)
+        positions.append(sums - np.repeat(sums[starts] - position_gaps[starts], chunk_tfs))
+    return np.concatenate(docs), np.concatenate(tfs), np.concatenate(positions)
+
+## Runs: files of (term, postings) records, sorted by term
+
+def write_record(f: BinaryIO, term: bytes, postings: bytes):
+    f.write(RECORD_HEADER.pack(len(term), len(postings)))
+    f.write(term)
+    f.write(postings)
+
+def iter_run(run_path: str, doc_offset: int = 0) -> Iterator[tuple[bytes, bytes]]:
+    # the records of a run, with doc_offset added to its doc ids
+    with open(run_path, "rb") as f:
+        while header := f.read(RECORD_HEADER.size):
+            term_size, postings_size = RECORD_HEADER.unpack(header)
+            term, postings = f.read(term_size), f.read(postings_size)
+            yield term, rebase_postings(postings, doc_offset) if doc_offset else postings
+
+def iter_merged_runs(runs: list[tuple[str, int]]) -> Iterator[tuple[bytes, bytes]]:
+    # merge runs of (run_path, doc_offset), whose doc ids increase from one run to the next. heapq.merge is stable,
+    # so the postings of a term are concatenated in run order, which keeps its doc ids sorted
+    merged = heapq.merge(*[iter_run(run_path, doc_offset) for run_path, doc_offset in runs], key=itemgetter(0))
+    for term, records in groupby(merged, key=itemgetter(0)):
+        yield term, b"".join(postings for _, postings in records)
+
+def index_byte_range(task: tuple[str, int, int, str]) -> dict[str, np.ndarray]:
+    # write the postings of the paragraphs in a byte range of a papers.jsonl file to a run at run_path, with doc ids
+    # counted from 0. returns the docs, in doc id order
+    filepath, start, end, run_path = task
+    vocab = {}
+    term_ids, doc_ids, positions = array("q"), array("q"), array("q")     # of every token, in doc order
+    docs = {"doc_corpusid": [], "doc_content_id": [], "doc_content_id_lengths": [], "doc_length": []}
+    for line in iter_lines(filepath, start, end, progress=False):
+        paper = json.loads(line)
+        corpusid = get_corpusid(paper)
+        for content_id, paragraph in iter_paragraphs(paper):
+            tokens = tokenize(get_text(paragraph))
+            term_ids.extend([vocab.setdefault(token, len(vocab)) for token in tokens])
+            doc_ids.extend([len(docs["doc_corpusid"])] * len(tokens))
+            positions.extend(range(len(tokens)))
+
+            docs["doc_corpusid"].append(corpusid)
+            docs["doc_content_id"] += content_id
+            docs["doc_content_id_lengths"].append(len(content_id))
+            docs["doc_length"].append(len(tokens))
+
+    # group the tokens by term, in term order. tokens were added in (doc id, position) order, and a stable sort
+    # keeps it within each term
+    terms = sorted(vocab)
+    term_ranks = np.empty(len(terms), dtype=np.int64)
+    term_ranks[[vocab[term] for term in terms]] = np.arange(len(terms))
+    token_ranks = term_ranks[np.frombuffer(term_ids, dtype=np.int64)]
+    order = np.argsort(token_ranks, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(token_ranks, minlength=len(terms)))])
+    gaps = get_gaps(
+        token_ranks[order],
+        np.frombuffer(doc_ids, dtype=np.int64)[order],
+        np.frombuffer(positions, dtype=np.int64)[order],
+        len(terms),
+    )
+    doc_bounds = gaps["doc_bounds"]
+
+    with open(run_path, "wb") as f:
+        for i, term in enumerate(terms):
+            write_record(f, term.encode("utf-8"), encode_postings(
+                gaps["doc_gaps"][doc_bounds[i]:doc_bounds[i+1]],
+                gaps["tfs"][doc_bounds[i]:doc_bounds[i+1]],
+                gaps["position_gaps"][bounds[i]:bounds[i+1]],
+            ))
+    return {name: np.asarray(values, dtype=np.int64) for name, values in docs.items()}
+
+## Building
+
+class DocWriter:
+    # appends the docs returned by index_byte_range, run after run
+    def __init__(self, out_dir: str):
+        self.num_docs = 0
+        self.num_tokens = 0
+        self.appenders = {
+            name: NpyAppender(os.path.join(out_dir, f"{name}.npy"), np.int64)
+            for name in ["doc_corpusid", "doc_content_id", "doc_length"]
+        }
+        self.indptr_appender = IndptrAppender(os.path.join(out_dir, "doc_content_id_indptr.npy"))
+
+    def append(self, docs: dict[str, np.ndarray]):
+        for name, appender in self.appenders.items():
+            appender.append(docs[name])
+        self.indptr_appender.append_lengths(docs["doc_content_id_lengths"])
+        self.num_docs += len(docs["doc_corpusid"])
+        self.num_tokens += int(docs["doc_length"].sum())
+
+    def close(self):
+        for appender in [*self.appenders.values(), self.indptr_appender]:
+            appender.close()
+
+    def abort(self):
+        for appender in [*self.appenders.values(), self.indptr_appender]:
+            appender.abort()
+
+    def __enter__(self) -> "DocWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_terms(records: Iterator[tuple[bytes, bytes]], out_dir: str) -> int:
+    # write the term dictionary and the postings of the merged records. returns the number of terms
+    num_terms = 0
+    with NpyAppender(os.path.join(out_dir, "term_text.npy"), np.uint8) as text_appender, \
+        IndptrAppender(os.path.join(out_dir, "term_text_indptr.npy")) as text_indptr_appender, \
+        IndptrAppender(os.path.join(out_dir, "term_postings_indptr.npy")) as postings_indptr_appender, \
+        NpyAppender(os.path.join(out_dir, "term_df.npy"), np.int64) as df_appender, \
+        open(os.path.join(out_dir, "postings.bin"), "wb") as f:
+        # buffered, as there can be hundreds of millions of terms
+        terms, postings_sizes, dfs = [], [], []
+        def flush():
+            text_appender.append(np.frombuffer(b"".join(terms), dtype=np.uint8))
+            text_indptr_appender.append_lengths([len(term) for term in terms])
+            postings_indptr_appender.append_lengths(postings_sizes)
+            df_appender.append(dfs)
+            terms.clear()
+            postings_sizes.clear()
+            dfs.clear()
+
+        for term, postings in records:
+            f.write(postings)
+            terms.append(term)
+            postings_sizes.append(len(postings))
+            dfs.append(count_docs(postings))
+            num_terms += 1
+            if len(terms) >= APPEND_BUFFER_SIZE:
+                flush()
+        flush()
+    return num_terms
+
+def build_text_index(
+        input_paths: list[str],
+        out_dir: str,
+        num_workers: int | None = None,
+        range_size: int = DEFAULT_INDEX_RANGE_SIZE,
+    ):
+    # index the paragraph texts of papers.jsonl files. byte ranges of the files are indexed in parallel into sorted
+    # runs on disk (one per range, so range_size bounds the memory of a worker), which are then merged in passes of
+    # at most MAX_MERGE_FANIN runs
+    os.makedirs(out_dir, exist_ok=True)
+    # the meta file is written last and marks a complete index, so that of a previous index must not outlive this
+    # one if it fails
+    if os.path.exists(os.path.join(out_dir, META_FILENAME)):
+        os.remove(os.path.join(out_dir, META_FILENAME))
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        tasks = [
+            (*byte_range, os.path.join(tmp_dir, f"pass-0-run-{i:05d}.bin"))
+            for i, byte_range in enumerate(
+                byte_range for input_path in input_paths for byte_range in split_byte_ranges(input_path, range_size)
+            )
+        ]
+
+        runs = []
+        with Pool(get_num_workers(num_workers)) as p, DocWriter(out_dir) as doc_writer, \
+            tqdm(total=sum(end - start for _, start, end, _ in tasks), unit="B", unit_scale=True) as pbar:
+            for (_, start, end, run_path), docs in zip(tasks, p.imap(index_byte_range, tasks)):
+                runs.append((run_path, doc_writer.num_docs))
+                doc_writer.append(docs)
+                pbar.update(end - start)
+
+        num_passes = 0
+        while len(runs) > MAX_MERGE_FANIN:
+            num_passes += 1
+            merged_runs = []
+            for i in range(0, len(runs), MAX_MERGE_FANIN):
+                merged_runs.append((os.path.join(tmp_dir, f"pass-{num_passes}-run-{len(merged_runs):05d}.bin"), 0))
+                with open(merged_runs[-1][0], "wb") as f:
+                    for term, postings in iter_merged_runs(runs[i:i+MAX_MERGE_FANIN]):
+                        write_record(f, term, postings)
+                for run_path, _ in runs[i:i+MAX_MERGE_FANIN]:
+                    os.remove(run_path)
+            runs = merged_runs
+
+        num_terms = write_terms(iter_merged_runs(runs), out_dir)
+
+    meta = {
+        "num_docs": doc_writer.num_docs,
+        "num_terms": num_terms,
+        "num_tokens": doc_writer.num_tokens,
+        "avg_doc_length": doc_writer.num_tokens / max(doc_writer.num_docs, 1),
+    }
+    with open(os.path.join(out_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+## Querying
+
+class TextIndex:
+    # read-only view of an index written by build_text_index. the arrays and the postings are memory-mapped, so a
+    # query only reads the dictionary pages of a binary search and the postings of its own terms. queries are
+    # tokenized like the paragraphs, and return doc ids (see get_docs)
+    def __init__(self, index_dir: str):
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, META_FILENAME), "r") as f:
+            self.meta = json.load(f)
+        self.doc_corpusid = load("doc_corpusid")
+        self.doc_content_id = load("doc_content_id")
+        self.doc_content_id_indptr = load("doc_content_id_indptr")
+        self.doc_length = load("doc_length")
+        self.term_text = load("term_text")
+        self.term_text_indptr = load("term_text_indptr")
+        self.term_postings_indptr = load("term_postings_indptr")
+        self.term_df = load("term_df")
+
+        postings_path = os.path.join(index_dir, "postings.bin")
+        self.f = open(postings_path, "rb")
+        self.postings = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(postings_path) else b""
+
+    def __len__(self) -> int:
+        return len(self.doc_corpusid)
+
+    def get_term(self, i: int) -> bytes:
+        return self.term_text[self.term_text_indptr[i]:self.term_text_indptr[i+1]].tobytes()
+
+    def find_term(self, term: str) -> int | None:
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self.term_df)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.term_df) and self.get_term(lo) == key else None
+
+    def get_df(self, term: str) -> int:
+        i = self.find_term(term)
+        return 0 if i is None else int(self.term_df[i])
+
+    def get_postings(self, term: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # see decode_postings; empty for terms that are not in the index
+        i = self.find_term(term)
+        if i is None:
+            return decode_postings(b"")
+        return decode_postings(self.postings[self.term_postings_indptr[i]:self.term_postings_indptr[i+1]])
+
+    def search_term(self, term: str) -> np.ndarray:
+        return self.get_postings(term.lower())[0]
+
+    def search_and(self, query: str) -> np.ndarray:
+        # docs that contain every term of query, starting from the rarest term
+        tokens = sorted(set(tokenize(query)), key=self.get_df)
+        if not tokens:
+            return np.zeros(0, dtype=np.int64)
+        docs = self.search_term(tokens[0])
+        for token in tokens[1:]:
+            if not len(docs):
+                break
+            docs = np.intersect1d(docs, self.search_term(token), assume_unique=True)
+        return docs
+
+    def search_phrase(self, query: str) -> np.ndarray:
+        # docs that contain the terms of query next to each other, in order. every occurrence in a candidate doc
+        # (one with all the terms) is keyed by the rank of its doc among the candidates and the position that the
+        # phrase would start at, as rank * stride + start, and the keys of all terms are intersected. positions are
+        # below the length of their doc, so keys are unique as long as stride is above the length of every candidate
+        tokens = tokenize(query)
+        candidates = docs = self.search_and(query)
+        if not len(candidates):
+            return candidates
+        stride = int(self.doc_length[candidates].max()) + 1
+        assert len(candidates) * stride <= np.iinfo(np.int64).max, "Too many long candidate docs to key phrases"
+        starts = None
+        for i, token in enumerate(tokens):
+            if not len(docs):
+                break
+            token_docs, tfs, positions = self.get_postings(token)
+            occurrence_docs = np.repeat(token_docs, tfs)
+            keep = np.isin(occurrence_docs, docs) & (positions >= i)
+            keys = np.searchsorted(candidates, occurrence_docs[keep]) * stride + (positions[keep] - i)
+            starts = np.unique(keys) if starts is None else np.intersect1d(starts, keys)
+            docs = candidates[np.unique(starts // stride)]
+        return docs
+
+    def search_bm25(
+            self,
+            query: str,
+            top_k: int = 10,
+            k1: float = BM25_K1,
+            b: float = BM25_B,
+        ) -> tuple[np.ndarray, np.ndarray]:
+        # the top_k docs that contain any term of query, by BM25 score, and their scores. ties go to the lower doc id
+        num_docs, avg_doc_length = len(self), max(self.meta["avg_doc_length"], 1e-9)
+        docs, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for token in set(tokenize(query)):
+            token_docs, tfs, _ = self.get_postings(token)
+            if not len(token_docs):
+                continue
+            idf = np.log(1 + (num_docs - len(token_docs) + 0.5) / (len(token_docs) + 0.5))
+            doc_lengths = self.doc_length[token_docs]
+            docs.append(token_docs)
+            scores.append(idf * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_lengths / avg_doc_length)))
+
+        docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(docs))
+        if 0 < top_k < len(docs):
+            # only the docs that score at least the top_k-th best score need to be sorted
+            keep = scores >= np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+            docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((docs, -scores))[:top_k]
+        return docs[order], scores[order]
+
+    def get_docs(self, docs: np.ndarray) -> list[dict]:
+        return [
+            {
+                "corpusid": int(self.doc_corpusid[doc]),
+                "content_id": self.doc_content_id[
+                    self.doc_content_id_indptr[doc]:self.doc_content_id_indptr[doc+1]
+                ].tolist(),
+            }
+            for doc in docs
+        ]
+
+    def close(self):
+        if isinstance(self.postings, mmap.mmap):
+            self.postings.close()
+        self.f.close()
+
+    def __enter__(self) -> "TextIndex":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,102 @@
+import argparse
+from dataclasses import asdict, fields
+import json
+import os
+import platform
+import subprocess
+
+from s2ag_parser.benchmark_utils import time_fn, time_stages
+from s2ag_parser.io_utils import encode_json_line
+from s2ag_parser.s2orc_utils import build_s2orc, build_s2orc_record
+from s2ag_parser.synthetic_utils import SyntheticConfig, generate_raw_s2orc
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(config: SyntheticConfig, num_papers: int, repeats: int, seed: int) -> dict:
+    raw_s2orcs = [generate_raw_s2orc(corpusid, config, seed) for corpusid in range(num_papers)]
+
+    stage2seconds = time_stages(raw_s2orcs, repeats)
+    end_to_end = {
+        "build_s2orc_record": time_fn(build_s2orc_record, raw_s2orcs, repeats),
+        "build_s2orc": time_fn(build_s2orc, raw_s2orcs, repeats),
+        "build_s2orc_record_to_json": time_fn(
+            lambda raw_s2orc: encode_json_line(build_s2orc_record(raw_s2orc).to_dict()), raw_s2orcs, repeats,
+        ),
+    }
+    text_bytes = sum(len(raw_s2orc["content"]["text"].encode("utf-8")) for raw_s2orc in raw_s2orcs)
+    return {
+        "config": asdict(config),
+        "num_papers": num_papers,
+        "mean_text_bytes": text_bytes / num_papers,
+        "stages_us_per_paper": {stage: seconds / num_papers * 1e6 for stage, seconds in stage2seconds.items()},
+        "end_to_end": {
+            name: {
+                "us_per_paper": seconds / num_papers * 1e6,
+                "papers_per_second": num_papers / seconds,
+                "text_mb_per_second": text_bytes / seconds / (1 << 20),
+            }
+            for name, seconds in end_to_end.items()
+        },
+    }
+
+def print_result(result: dict, previous: dict | None = None):
+    # per-paper times of every stage, with the ratio to a previous run of the same scale if there is one
+    def fmt(name: str, us: float, previous_us: float | None) -> str:
+        ratio = f"  ({us / previous_us:.2f}x)" if previous_us else ""
+        return f"  {name:<34}{us:>12.1f}us{ratio}"
+
+    for stage, us in result["stages_us_per_paper"].items():
+        print(fmt(stage, us, previous and previous["stages_us_per_paper"].get(stage)))
+    for name, stats in result["end_to_end"].items():
+        previous_us = previous and previous["end_to_end"].get(name, {}).get("us_per_paper")
+        print(fmt(name, stats["us_per_paper"], previous_us) + f"  {stats['papers_per_second']:.0f} papers/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-papers", type=int, default=200,
+        help="Number of synthetic papers per scale")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4, 8],
+        help="Multipliers of the number of sections, bibentries, figures and formulas per paper. Stages whose time "
+             "per paper grows faster than the scale are superlinear")
+    parser.add_argument("--repeats", type=int, default=3,
+        help="Number of timed runs, of which the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out-path", default="benchmark.json",
+        help="JSON file to write the results to")
+    parser.add_argument("--compare", default=None,
+        help="JSON file written by an earlier run (e.g. on another commit) to compare against")
+    for field in fields(SyntheticConfig):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type, default=field.default)
+    args = parser.parse_args()
+
+    config = SyntheticConfig(**{field.name: getattr(args, field.name) for field in fields(SyntheticConfig)})
+    previous_results = {}
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)
+        print(f"Comparing against {args.compare} (commit {previous['commit']})")
+        previous_results = {result["scale"]: result for result in previous["results"]}
+
+    results = []
+    for scale in args.scales:
+        print(f"{scale=}")
+        result = {"scale": scale, **benchmark(config.scaled(scale), args.num_papers, args.repeats, args.seed)}
+        print_result(result, previous_results.get(scale))
+        results.append(result)
+
+    with open(args.out_path, "w") as f:
+        json.dump({
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "repeats": args.repeats,
+            "seed": args.seed,
+            "results": results,
+        }, f, indent=2)
+    print(f"Results written to {args.out_path}")
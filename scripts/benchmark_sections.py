@@ -0,0 +1,31 @@
+import argparse
+import time
+
+from s2ag_parser.s2orc_utils import nest_sections, reassign_content_ids
+from s2ag_parser.records import Section, Span, TextSpan
+from s2ag_parser.synthetic_utils import get_section_numbers
+
+def make_sections(num_sections: int, depth: int) -> list[Section]:
+    sections = []
+    for i, n in enumerate(get_section_numbers(num_sections, depth)):
+        sections.append(Section(
+            content_id = (i,),
+            section_level = tuple(n.split(".")),
+            header = TextSpan(text=n, original_span=Span(start=i, end=i+1)),
+            contents = [],
+        ))
+    return sections
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000, 16000])
+    parser.add_argument("--depth", type=int, default=5)
+    args = parser.parse_args()
+
+    for num_sections in args.sizes:
+        sections = make_sections(num_sections, args.depth)
+        start = time.perf_counter()
+        nested_sections = nest_sections(sections)
+        reassign_content_ids(nested_sections)
+        elapsed = time.perf_counter() - start
+        print(f"{num_sections=}: {elapsed:.4f}s total, {elapsed / num_sections * 1e6:.2f}us per section")
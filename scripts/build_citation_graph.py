@@ -0,0 +1,33 @@
+import argparse
+from multiprocessing import Pool
+
+from s2ag_parser.graph_utils import CitationGraph, CitationGraphBuilder, extract_citations
+from s2ag_parser.io_utils import batched, iter_lines_from_files
+from s2ag_parser.pool_utils import DEFAULT_BATCH_SIZE, MAX_IN_FLIGHT_PER_WORKER, get_num_workers, imap_batches
+from s2ag_parser.sort_utils import DEFAULT_MAX_MEMORY_BYTES
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-paths", nargs="+", default=["data/extracted/papers.jsonl"],
+        help="papers.jsonl files (or part files) to read the citations from")
+    parser.add_argument("--out-dir", default="data/extracted/citation_graph",
+        help="Directory to write the .npy arrays of the graph to")
+    parser.add_argument("--num-workers", type=int, default=None,
+        help="Number of worker processes (default: os.cpu_count())")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of lines sent to a worker at a time")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_BYTES >> 20,
+        help="Approximate memory used to sort the edges; larger graphs are sorted in several buckets. The sorted "
+            "corpusids of all nodes are held in memory besides")
+    args = parser.parse_args()
+    num_workers = get_num_workers(args.num_workers)
+
+    print(f"Writing the citation graph to {args.out_dir}")
+    with Pool(num_workers) as p, CitationGraphBuilder(args.out_dir, args.max_memory_mb << 20) as builder:
+        # extract_citations works on a whole batch at a time, so each batch is sent as a batch of one
+        batches = ([batch] for batch in batched(iter_lines_from_files(args.input_paths), args.batch_size))
+        for [citations] in imap_batches(p, extract_citations, batches, MAX_IN_FLIGHT_PER_WORKER * num_workers):
+            builder.append(*citations)
+
+    graph = CitationGraph(args.out_dir)
+    print(f"{len(graph)} nodes ({int(graph.node_is_paper.sum())} parsed papers), {graph.num_edges} edges")
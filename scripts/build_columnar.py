@@ -0,0 +1,26 @@
+import argparse
+from multiprocessing import Pool
+
+from s2ag_parser.columnar_utils import ColumnarWriter, flatten_papers
+from s2ag_parser.io_utils import batched, iter_lines_from_files
+from s2ag_parser.pool_utils import DEFAULT_BATCH_SIZE, MAX_IN_FLIGHT_PER_WORKER, get_num_workers, imap_batches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-paths", nargs="+", default=["data/extracted/papers.jsonl"],
+        help="papers.jsonl files (or part files) to export, in order")
+    parser.add_argument("--out-dir", default="data/extracted/columnar",
+        help="Directory to write the .npy columns to")
+    parser.add_argument("--num-workers", type=int, default=None,
+        help="Number of worker processes (default: os.cpu_count())")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of lines sent to a worker at a time")
+    args = parser.parse_args()
+    num_workers = get_num_workers(args.num_workers)
+
+    print(f"Writing columns to {args.out_dir}")
+    with Pool(num_workers) as p, ColumnarWriter(args.out_dir) as writer:
+        # flatten_papers works on a whole batch at a time, so each batch is sent as a batch of one
+        batches = ([batch] for batch in batched(iter_lines_from_files(args.input_paths), args.batch_size))
+        for [columns] in imap_batches(p, flatten_papers, batches, MAX_IN_FLIGHT_PER_WORKER * num_workers):
+            writer.append(columns)
@@ -0,0 +1,15 @@
+import argparse
+
+from s2ag_parser.index_utils import DEFAULT_MAX_MEMORY_BYTES, build_offset_index, get_index_paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_paths", nargs="*", default=["data/extracted/papers.jsonl"],
+        help="jsonl files to index by corpusid")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_BYTES >> 20,
+        help="Approximate peak memory used when sorting the index")
+    args = parser.parse_args()
+
+    for data_path in args.data_paths:
+        print(f"Indexing {data_path} into {get_index_paths(data_path)}")
+        build_offset_index(data_path, args.max_memory_mb << 20)
@@ -1,11 +1,46 @@
+import argparse
 import glob
 import json
 from multiprocessing import Pool
 import os
+import sys
+import time
+from typing import Callable
+
 from tqdm import tqdm
 
-from s2ag_parser.schemas import MetadataSchema
+from s2ag_parser.schemas import MetadataSchema, MetadataWithAbstractSchema
+from s2ag_parser.checkpoint_utils import (
+    CheckpointStore, 
+    get_checkpoint_dir, 
+    get_fingerprint, 
+    get_shard_record, 
+    is_merged, 
+    is_shard_done, 
+    merge_and_release_parts, 
+    remove_shard_record, 
+)
 from s2ag_parser.datautils import strip_whitespace
+from s2ag_parser.index_utils import build_offset_index, get_index_paths
+from s2ag_parser.io_utils import (
+    atomic_output, 
+    batched, 
+    concat_files, 
+    get_manifest_path, 
+    get_part_path, 
+    iter_lines, 
+    write_manifest, 
+)
+from s2ag_parser.metadata_utils import build_metadata_lookup, get_lookup_paths
+from s2ag_parser.metrics_utils import DEFAULT_METRICS_INTERVAL_SECONDS, BuildMetrics
+from s2ag_parser.partition_utils import (
+    check_no_duplicate_corpusids, 
+    check_partitions_present, 
+    get_partition_path, 
+    select_partition, 
+)
+from s2ag_parser.pool_utils import DEFAULT_BATCH_SIZE, MAX_IN_FLIGHT_PER_WORKER, get_num_workers, imap_batches
+from s2ag_parser.sort_utils import DEFAULT_MAX_MEMORY_BYTES, external_sort, iter_keyed_lines, merge_join
 
 def extract_abstract(line: str) -> dict | None:
     x = json.loads(line)
@@ -55,87 +90,216 @@ def extract_metadata(line: str) -> dict | None:
         corpusid=corpusid, 
         title=title, 
         year=year, 
-        abstract="",   # hardcoded for now only
     ).model_dump()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=None,
+        help="Number of worker processes (default: os.cpu_count())")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of lines sent to a worker at a time")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_BYTES >> 20,
+        help="Approximate peak memory used when sorting abstracts and metadata by corpusid, and when indexing them")
+    parser.add_argument("--metrics-dir", default=None,
+        help="Directory to write the metrics snapshots of the extraction steps (a prometheus textfile and a JSON "
+             "summary) to (default: next to the output)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_METRICS_INTERVAL_SECONDS,
+        help="Minimum number of seconds between two metrics snapshots")
+    parser.add_argument("--num-partitions", type=int, default=1,
+        help="Number of nodes the extraction of abstracts and metadata is split over. Each node is given a "
+             "deterministic share of the shards, and writes its own partitioned outputs")
+    parser.add_argument("--partition-index", type=int, default=0,
+        help="Index of the partition extracted by this node, in [0, num-partitions)")
+    parser.add_argument("--merge-partitions", action="store_true",
+        help="Combine the outputs of all --num-partitions partitions, after checking that all of them are present "
+             "and that no corpusid is in more than one, and build the joined metadata, indexes and lookup")
+    args = parser.parse_args()
+    if args.merge_partitions and args.num_partitions == 1:
+        parser.error("--merge-partitions requires --num-partitions > 1")
+    num_workers = get_num_workers(args.num_workers)
+    max_in_flight = MAX_IN_FLIGHT_PER_WORKER * num_workers
+    max_memory_bytes = args.max_memory_mb << 20
+
+    # with several partitions, every node extracts abstracts and metadata (steps 1 and 3) from its own share of the
+    # shards. the remaining steps need all of them, so they run once, with --merge-partitions
+    num_partitions, partition_index = args.num_partitions, args.partition_index
+    partitioned = num_partitions > 1 and not args.merge_partitions
+    metadata_path = "data/extracted/metadata.jsonl"
+
+    # abstracts and metadata are extracted shard by shard, with a completion record per shard (see extract_lines).
+    # every other step records the fingerprints of its inputs once its outputs are complete, so that a rerun only
+    # redoes the steps whose inputs changed (or that never finished)
+    store = CheckpointStore(get_checkpoint_dir(get_partition_path(metadata_path, partition_index, num_partitions) 
+                                               if partitioned else metadata_path))
+
+    # a single pool is shared by all steps, so that workers are only started once
+    p = Pool(num_workers)
+
+    metrics = BuildMetrics(
+        get_partition_path(metadata_path, partition_index, num_partitions) if partitioned else metadata_path, 
+        "build_metadata", num_workers, 
+        labels = {"partition": f"{partition_index}-of-{num_partitions}"} if partitioned else None,
+        metrics_dir = args.metrics_dir, 
+        interval_seconds = args.metrics_interval,
+    )
+
+    def extract_shard(key: str, fn: Callable[[str], dict | None], filepath: str, part_path: str) -> dict:
+        shard = f"{key}/{os.path.basename(filepath)}"
+        metrics.start_shard(shard)
+        start_time = time.perf_counter()
+        counts = {"num_lines": 0, "num_papers": 0}
+        with atomic_output(part_path) as tmp_path, open(tmp_path, "w") as f_out:
+            batches = batched(iter_lines(filepath), args.batch_size)
+            for results in imap_batches(p, fn, batches, max_in_flight, metrics.add_busy_seconds):
+                lines = [json.dumps(result) for result in results if result is not None]
+                for line in lines:
+                    print(line, file=f_out)
+                counts["num_lines"] += len(results)
+                counts["num_papers"] += len(lines)
+                metrics.add(
+                    lines=len(results), papers=len(lines), failures=len(results) - len(lines), 
+                    output_bytes=sum(len(line) + 1 for line in lines),
+                )
+                metrics.maybe_write()
+        metrics.add(input_bytes=os.path.getsize(filepath))
+        metrics.finish_shard(shard, **counts)
+        return {
+            "path": part_path, 
+            "filepath": filepath, "start": 0, "end": os.path.getsize(filepath), 
+            **counts, 
+            "seconds": time.perf_counter() - start_time,
+        }
+
+    def extract_lines(key: str, fn: Callable[[str], dict | None], filepaths: list[str], out_path: str):
+        # every shard is written to its own part, and gets a completion record once it is written, as in
+        # build_papers.py. shards whose record matches their current fingerprint are skipped, and the parts are
+        # then merged into out_path (unless it already is their merge)
+        shard_store = CheckpointStore(get_checkpoint_dir(out_path))
+        fingerprints, merged_fingerprints = {}, {}
+        todo_filepaths = []
+        for filepath in filepaths:
+            shard = os.path.basename(filepath)
+            fingerprints[shard] = get_fingerprint(filepath)
+            units = [(filepath, 0, os.path.getsize(filepath))]
+            if is_shard_done(shard_store, shard, fingerprints[shard], units, merged_fingerprints):
+                record = shard_store.load(shard)
+                metrics.finish_shard(
+                    f"{key}/{shard}", status="skipped", seconds=0., 
+                    num_lines=record["num_lines"], num_papers=record["num_papers"],
+                )
+                continue
+            remove_shard_record(shard_store, shard)
+            todo_filepaths.append(filepath)
+        print(f"Number of shards to (re)build: {len(todo_filepaths)} (skipping {len(filepaths) - len(todo_filepaths)})")
+
+        # shards are processed one after the other, so that the time of each can be reported
+        for i, filepath in enumerate(todo_filepaths):
+            print(f"Filepath {i}: {filepath}")
+            shard = os.path.basename(filepath)
+            metrics.set_backlog(len(todo_filepaths) - i - 1)
+            part = extract_shard(key, fn, filepath, get_part_path(out_path, 0, shard=shard))
+            shard_store.save(shard, get_shard_record(fingerprints[shard], [part]))
+        metrics.set_backlog(0)
+
+        records = [shard_store.load(os.path.basename(filepath)) for filepath in filepaths]
+        manifest_path = get_manifest_path(out_path)
+        write_manifest(manifest_path, [part for record in records for part in record["parts"]])
+        if todo_filepaths or not is_merged(records, out_path):
+            print(f"Merging parts into {out_path}")
+            merge_and_release_parts(manifest_path, out_path, [(shard_store, manifest_path)])
+
+    def merge_partitions(partition_paths: list[str], out_path: str):
+        print(f"Checking corpusids of {num_partitions} partitions...")
+        check_no_duplicate_corpusids([[(path, 0, os.path.getsize(path))] for path in partition_paths])
+        print(f"Merging partitions into {out_path}")
+        concat_files(partition_paths, out_path)
+
+    def extract_step(key: str, fn: Callable[[str], dict | None], filepaths: list[str], out_path: str):
+        if args.merge_partitions:
+            partition_paths = [get_partition_path(out_path, i, num_partitions) for i in range(num_partitions)]
+            check_partitions_present(partition_paths)
+            store.run_step(key, partition_paths, [out_path], lambda: merge_partitions(partition_paths, out_path))
+        else:
+            filepaths = select_partition(
+                filepaths, [os.path.getsize(filepath) for filepath in filepaths], num_partitions, partition_index,
+            )
+            extract_lines(key, fn, filepaths, get_partition_path(out_path, partition_index, num_partitions))
+
     # Step 1: Extract abstracts and write to a file
     print(f"Extracting abstracts...")
     filepaths = sorted(list(glob.glob("data/raw/abstracts/*")))
     print(f"Total number of filepaths: {len(filepaths)}")
 
     abstracts_path = "data/extracted/abstracts.jsonl"
-    if os.path.exists(abstracts_path):
-        print(f"Abstracts already exist at {abstracts_path}")
-    else:
-        print(f"Writing to {abstracts_path}")
-        with open(abstracts_path, "w") as f_out:
-            for i, filepath in enumerate(filepaths):
-                print(f"Filepath {i}: {filepath}")
-                with open(filepath, "r") as f, Pool(10) as p:
-                    for result in p.imap(extract_abstract, tqdm(f.readlines())):
-                        if result is not None:
-                            print(json.dumps(result), file=f_out, flush=True)
+    extract_step("abstracts", extract_abstract, filepaths, abstracts_path)
     print()
 
-    # # Step 2: Creating abstracts index
-    # abstracts_line_num2corpusid_path = "data/extracted/abstracts_line_num2corpusid.json"
-    # if os.path.exists(abstracts_line_num2corpusid_path):
-    #     print(f"Abstracts index already exists at {abstracts_line_num2corpusid_path}")
-    #     with open(abstracts_line_num2corpusid_path, "r") as f:
-    #         abstracts_line_num2corpusid = json.load(f)
-    # else:
-    #     print(f"Constructing abstracts index based on {abstracts_path}...")
-    #     abstracts_line_num2corpusid = []
-    #     with open(abstracts_path, "r") as f_abstracts:
-    #         for line in tqdm(f_abstracts):
-    #             x = json.loads(line)
-    #             abstracts_line_num2corpusid.append(x["corpusid"])
-    #     print(f"Writing to {abstracts_line_num2corpusid_path}")
-    #     with open(abstracts_line_num2corpusid_path, "w") as f_out:
-    #         json.dump(abstracts_line_num2corpusid, f_out)
-    # print()        
-
-    # Step 3: Creating metadata items (hardcode abstract to empty string for now)
+    # Step 2: Creating abstracts index
+    if not partitioned:
+        print(f"Constructing abstracts index based on {abstracts_path}...")
+        store.run_step("abstracts_index", [abstracts_path], list(get_index_paths(abstracts_path)), 
+            lambda: build_offset_index(abstracts_path, max_memory_bytes))
+        print()
+
+    # Step 3: Creating metadata items (abstracts are joined in at step 4)
     print(f"Building metadata...")
     filepaths = sorted(list(glob.glob("data/raw/papers/*")))
     print(f"Total number of filepaths: {len(filepaths)}")
 
     metadata_noabstract_path = "data/extracted/metadata_noabstract.jsonl"
-    print(f"Writing to {metadata_noabstract_path}...")
-    f_out = open(metadata_noabstract_path, "w")
-    for i, filepath in enumerate(filepaths):
-        print(f"Filepath {i}: {filepath}")
-        with open(filepath, "r") as f, Pool(10) as p:
-            for result in p.imap(extract_metadata, tqdm(f.readlines())):
-                if result is not None:
-                    print(json.dumps(result), file=f_out)
-    f_out.close()
+    extract_step("metadata_noabstract", extract_metadata, filepaths, metadata_noabstract_path)
     print()
-    
-    # # Step 3: Read in abstracts line by line, find corresponding entry in memory, and write to final file
-    # metadata_path = "data/extracted/metadata.jsonl"
-    # corpusid2line_num = {}
-    # line_num = 0
-    # print(f"Writing to {metadata_path}")
-    # with open(abstracts_path, "r") as f_in, open(metadata_path, "w") as f_out:
-    #     for line in tqdm(f_in):
-    #         x = json.loads(line)
-
-    #         corpusid = x["corpusid"]
-    #         if corpusid not in corpusid2main_info:
-    #             print(f"Could not find entry with {corpusid=}")
-    #         else:
-    #             temp = dict(**corpusid2main_info[corpusid])
-    #             temp["abstract"] = x["abstract"]
-    #             metadata = MetadataSchema(**temp).model_dump()
-    #             print(json.dumps(metadata), file=f_out, flush=True)
-
-    #             corpusid2line_num[corpusid] = line_num
-    #             line_num += 1
-
-    # # Step 4: Write out corpusid to line number mapping
-    # corpusid2metadata_line_num = "data/extracted/corpusid2metadata_line_num.json"
-    # print(f"Writing to {corpusid2metadata_line_num}")
-    # with open(corpusid2metadata_line_num, "w") as f_out:
-    #     json.dump(corpusid2line_num, f_out)
\ No newline at end of file
+
+    p.close()
+    p.join()
+
+    metrics.finish()
+    print(f"Metrics written to {metrics.prom_path} and {metrics.json_path}")
+
+    if partitioned:
+        print(f"Partition {partition_index} of {num_partitions} is done. "
+              f"Once all partitions are, rerun with --merge-partitions to build the rest")
+        sys.exit()
+
+    # Step 4: Sort abstracts and metadata by corpusid in bounded memory, then merge join them into the final file
+
+    def join_metadata():
+        sorted_paths = {}
+        for path in [abstracts_path, metadata_noabstract_path]:
+            root, ext = os.path.splitext(path)
+            sorted_paths[path] = f"{root}.sorted{ext}"
+            print(f"Sorting {path} by corpusid into {sorted_paths[path]}...")
+            external_sort(path, sorted_paths[path], max_memory_bytes)
+
+        print(f"Writing to {metadata_path}")
+        num_missing_abstracts = 0
+        with atomic_output(metadata_path) as tmp_path, open(tmp_path, "w") as f_out:
+            for metadata_line, abstract_line in tqdm(merge_join(
+                    iter_keyed_lines(sorted_paths[metadata_noabstract_path]), 
+                    iter_keyed_lines(sorted_paths[abstracts_path]),
+                )):
+                if abstract_line is None:
+                    abstract = ""
+                    num_missing_abstracts += 1
+                else:
+                    abstract = json.loads(abstract_line)["abstract"]
+                metadata = MetadataWithAbstractSchema(**json.loads(metadata_line), abstract=abstract).model_dump()
+                print(json.dumps(metadata), file=f_out)
+        print(f"Number of entries without an abstract: {num_missing_abstracts}")
+        for sorted_path in sorted_paths.values():
+            os.remove(sorted_path)
+
+    store.run_step("metadata", [abstracts_path, metadata_noabstract_path], [metadata_path], join_metadata)
+    print()
+
+    # Step 5: Creating metadata index
+    print(f"Constructing metadata index based on {metadata_path}...")
+    store.run_step("metadata_index", [metadata_path], list(get_index_paths(metadata_path)), 
+        lambda: build_offset_index(metadata_path, max_memory_bytes))
+    print()
+
+    # Step 6: Creating the title/year lookup used by build_papers.py
+    metadata_lookup_dir = "data/extracted/metadata_lookup"
+    print(f"Constructing metadata lookup in {metadata_lookup_dir}...")
+    store.run_step("metadata_lookup", [metadata_path], list(get_lookup_paths(metadata_lookup_dir).values()), 
+        lambda: build_metadata_lookup(metadata_path, metadata_lookup_dir))
@@ -1,32 +1,429 @@
+import argparse
+from collections import Counter
+from functools import partial
 import glob
 import json
 from multiprocessing import Pool
+import os
+import random
+import sys
+import time
 from tqdm import tqdm
 
-from s2ag_parser.s2orc_utils import build_s2orc
+from s2ag_parser.checkpoint_utils import (
+    CheckpointStore, 
+    get_checkpoint_dir, 
+    get_fingerprint, 
+    get_shard_record, 
+    is_merged, 
+    is_shard_done, 
+    merge_and_release_parts, 
+    remove_shard_record, 
+)
+from s2ag_parser.io_utils import (
+    atomic_output, 
+    batched, 
+    encode_json_line, 
+    get_manifest_path, 
+    get_part_path, 
+    get_part_range, 
+    iter_lines, 
+    read_manifest, 
+    split_byte_ranges, 
+    write_manifest,
+)
+from s2ag_parser.metadata_utils import MetadataLookup
+from s2ag_parser.metrics_utils import DEFAULT_METRICS_INTERVAL_SECONDS, BuildMetrics
+from s2ag_parser.partition_utils import (
+    check_no_duplicate_corpusids, 
+    check_partitions_present, 
+    get_partition_path, 
+    select_partition, 
+)
+from s2ag_parser.pool_utils import (
+    DEFAULT_BATCH_SIZE, 
+    DEFAULT_QUEUE_SIZE, 
+    MAX_IN_FLIGHT_PER_WORKER, 
+    Pipeline, 
+    get_num_workers, 
+)
+from s2ag_parser.profile_utils import PaperProfile, ProfileAggregator
+from s2ag_parser.s2orc_utils import build_s2orc_record
 from s2ag_parser.schemas import PaperSchema
 
-def process_line(line: str) -> dict | None:
+DEFAULT_METADATA_LOOKUP_DIR = "data/extracted/metadata_lookup"
+EMPTY_METADATA = {"title": None, "year": None}
+
+# opened once per worker by init_worker. the lookup is memory-mapped, so it is shared by all workers, not copied
+metadata_lookup: MetadataLookup | None = None
+
+def init_worker(metadata_lookup_dir: str | None):
+    global metadata_lookup
+    if metadata_lookup_dir is not None:
+        metadata_lookup = MetadataLookup(metadata_lookup_dir)
+
+def get_metadata(corpusid: int) -> dict:
+    if metadata_lookup is None:
+        return EMPTY_METADATA
+    return metadata_lookup.get(corpusid) or EMPTY_METADATA
+
+def should_validate(corpusid: int, validate_fraction: float) -> bool:
+    # seeded by corpusid, so that reruns validate the same papers
+    return validate_fraction >= 1 or random.Random(corpusid).random() < validate_fraction
+
+def process_line(line: str, validate_fraction: float = 1., profile: PaperProfile | None = None) -> dict | None:
     raw_s2orc = json.loads(line)
+    if profile is not None:
+        profile.lap("decode_json")
     try:
-        s2orc = build_s2orc(raw_s2orc).model_dump()
-        metadata = {"title": None, "year": None}
-        paper = PaperSchema(**s2orc, **metadata).model_dump()
+        metadata = get_metadata(raw_s2orc["corpusid"])
+        if profile is not None:
+            profile.lap("get_metadata")
+        if should_validate(raw_s2orc["corpusid"], validate_fraction):
+            record = build_s2orc_record(raw_s2orc, profile).to_dict() | metadata
+            paper = PaperSchema.model_validate(record).model_dump()
+            if profile is not None:
+                profile.lap("validate")
+        else:
+            # trusted mode: skip validation, and convert the parsed record straight to the dict that
+            # PaperSchema.model_dump would produce
+            paper = build_s2orc_record(raw_s2orc, profile).to_dict() | metadata
+            if profile is not None:
+                profile.lap("to_dict")
         return paper
-    except:
-        print(f"Something went wrong with processing corpusid={raw_s2orc['corpusid']}")
+    except Exception as e:
+        # the caller counts the papers that come back as None as failures
+        print(f"Something went wrong with processing corpusid={raw_s2orc['corpusid']}: {e!r}")
         return None
 
+def process_line_to_json(line: str, validate_fraction: float = 1., profile: PaperProfile | None = None) -> bytes | None:
+    # serialize in the worker, so that the parent only receives (and writes) finished bytes
+    paper = process_line(line, validate_fraction, profile)
+    result = None if paper is None else encode_json_line(paper)
+    if profile is not None:
+        profile.lap("encode_json")
+    return result
+
+def process_lines_profiled(
+        lines: list[str], 
+        validate_fraction: float = 1., 
+        top_n: int = 10,
+    ) -> tuple[list[bytes | None], ProfileAggregator]:
+    # profiles are aggregated over the whole batch in the worker, so only the aggregate is sent back
+    aggregator = ProfileAggregator(top_n)
+    results = []
+    for line in lines:
+        profile = PaperProfile()
+        results.append(process_line_to_json(line, validate_fraction, profile))
+        aggregator.add(profile)
+    return results, aggregator
+
+def process_byte_range(
+        task: tuple[str, str, int, int], 
+        validate_fraction: float = 1., 
+        profile_top_n: int | None = None,
+    ) -> dict:
+    # read the raw lines and write the results in the worker itself, so that only the byte range is sent over
+    # and only a small summary of the written part is sent back (with the aggregated profiles, if profiling)
+    part_path, filepath, start, end = task
+    aggregator = None if profile_top_n is None else ProfileAggregator(profile_top_n)
+    start_time = time.perf_counter()
+    num_lines, num_papers = 0, 0
+    with atomic_output(part_path) as tmp_path, open(tmp_path, "wb") as f_out:
+        for line in iter_lines(filepath, start, end, progress=False):
+            num_lines += 1
+            if aggregator is None:
+                result = process_line_to_json(line, validate_fraction)
+            else:
+                profile = PaperProfile()
+                result = process_line_to_json(line, validate_fraction, profile)
+                aggregator.add(profile)
+            if result is not None:
+                f_out.write(result)
+                num_papers += 1
+    part = {
+        "path": part_path, 
+        "filepath": filepath, "start": start, "end": end, 
+        "num_lines": num_lines, "num_papers": num_papers, 
+        "seconds": time.perf_counter() - start_time,
+    }
+    return part if aggregator is None else part | {"profile": aggregator}
+
+def process_shard_stream(
+        p, 
+        part_path: str, 
+        filepath: str, 
+        batch_size: int, 
+        queue_size: int, 
+        max_in_flight: int, 
+        validate_fraction: float = 1.,
+        aggregator: ProfileAggregator | None = None,
+        metrics: BuildMetrics | None = None,
+    ) -> dict:
+    # parse one shard through a read/parse/write pipeline into its own part. if an aggregator is given, papers are
+    # profiled, and the aggregated profiles of every batch are merged into it
+    start_time = time.perf_counter()
+    counts = {"num_lines": 0, "num_papers": 0}
+    with atomic_output(part_path) as tmp_path, open(tmp_path, "wb") as f_out:
+        def write_results(results: list[bytes | None]):
+            papers = [result for result in results if result is not None]
+            data = b"".join(papers)
+            f_out.write(data)
+            counts["num_lines"] += len(results)
+            counts["num_papers"] += len(papers)
+            if metrics is not None:
+                metrics.add(
+                    lines=len(results), papers=len(papers), failures=len(results) - len(papers), 
+                    output_bytes=len(data),
+                )
+                metrics.set_queue_depths(pipeline.get_queue_depths())
+                metrics.maybe_write()
+
+        def write_profiled_results(results: list[tuple[list[bytes | None], ProfileAggregator]]):
+            [(results, batch_aggregator)] = results
+            write_results(results)
+            aggregator.merge(batch_aggregator)
+
+        batches = batched(iter_lines(filepath), batch_size)
+        if aggregator is None:
+            fn, sink = partial(process_line_to_json, validate_fraction=validate_fraction), write_results
+        else:
+            # process_lines_profiled works on a whole batch at a time, so each batch is sent as a batch of one
+            fn = partial(process_lines_profiled, validate_fraction=validate_fraction, top_n=aggregator.top_n)
+            batches, sink = ([batch] for batch in batches), write_profiled_results
+
+        pipeline = Pipeline(
+            pool = p, 
+            fn = fn, 
+            batches = batches, 
+            sink = sink, 
+            max_in_flight = max_in_flight, 
+            queue_size = queue_size,
+            on_busy = None if metrics is None else metrics.add_busy_seconds,
+        )
+        pipeline.run()
+    print(f"Mean queue depths: {pipeline.get_mean_queue_depths()}")
+    return {
+        "path": part_path, 
+        "filepath": filepath, "start": 0, "end": os.path.getsize(filepath), 
+        **counts, 
+        "seconds": time.perf_counter() - start_time,
+    }
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["stream", "ranges"], default="stream",
+        help="stream: read shards in the parent and send lines to the workers; "
+             "ranges: send (filepath, start, end) byte ranges and let the workers read the shards themselves")
+    parser.add_argument("--range-size", type=int, default=64 * 1024 * 1024,
+        help="Approximate number of bytes per byte range in ranges mode")
+    parser.add_argument("--merge", action="store_true",
+        help="In ranges mode, also concatenate the written parts into a single file "
+             "(always done in stream mode). Parts are then removed, and the checkpoints point into the merged file, "
+             "so that reruns can still skip finished shards")
+    parser.add_argument("--num-workers", type=int, default=None,
+        help="Number of worker processes (default: os.cpu_count())")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of lines sent to a worker at a time in stream mode")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+        help="Maximum number of batches buffered between the read, parse and write stages in stream mode")
+    parser.add_argument("--validate-fraction", type=float, default=1.,
+        help="Fraction of papers that go through full pydantic validation; "
+             "the others are built without validation (default: 1, i.e. validate every paper)")
+    parser.add_argument("--metadata-lookup-dir", default=DEFAULT_METADATA_LOOKUP_DIR,
+        help="Metadata lookup written by build_metadata.py, used to attach titles and years to papers")
+    parser.add_argument("--profile-top-n", type=int, default=None,
+        help="Profile the parsing of every paper, and end with the time spent per stage and the N slowest papers "
+             "(default: no profiling)")
+    parser.add_argument("--metrics-dir", default=None,
+        help="Directory to write the metrics snapshots (a prometheus textfile and a JSON summary) to "
+             "(default: next to the output)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_METRICS_INTERVAL_SECONDS,
+        help="Minimum number of seconds between two metrics snapshots")
+    parser.add_argument("--num-partitions", type=int, default=1,
+        help="Number of nodes the build is split over. Each node is given a deterministic share of the shards "
+             "(stream mode) or byte ranges (ranges mode), and writes its own partitioned outputs")
+    parser.add_argument("--partition-index", type=int, default=0,
+        help="Index of the partition built by this node, in [0, num-partitions)")
+    parser.add_argument("--merge-partitions", action="store_true",
+        help="Instead of building, combine the outputs of all --num-partitions partitions, after checking that "
+             "all of them are present and that no corpusid is in more than one")
+    args = parser.parse_args()
+    if args.merge_partitions and args.num_partitions == 1:
+        parser.error("--merge-partitions requires --num-partitions > 1")
+    num_workers = get_num_workers(args.num_workers)
+    out_path = "data/extracted/papers.jsonl"
+
+    if args.merge_partitions:
+        # combine the manifests written by every node, after checking that they are all there and do not overlap
+        manifest_paths = [
+            get_manifest_path(get_partition_path(out_path, i, args.num_partitions)) 
+            for i in range(args.num_partitions)
+        ]
+        check_partitions_present(manifest_paths)
+        partition_parts = [read_manifest(manifest_path) for manifest_path in manifest_paths]
+        print(f"Checking corpusids of {args.num_partitions} partitions...")
+        check_no_duplicate_corpusids([[get_part_range(part) for part in parts] for parts in partition_parts])
+
+        manifest_path = get_manifest_path(out_path)
+        print(f"Writing manifest to {manifest_path}")
+        # parts are put back in input order, so that the result is the same as that of a single node
+        parts = sorted(
+            (part for parts in partition_parts for part in parts), key=lambda part: (part["filepath"], part["start"]),
+        )
+        write_manifest(manifest_path, parts)
+        if args.merge or args.mode == "stream":
+            print(f"Merging parts into {out_path}")
+            partitions = [
+                (CheckpointStore(get_checkpoint_dir(get_partition_path(out_path, i, args.num_partitions))), path)
+                for i, path in enumerate(manifest_paths)
+            ]
+            merge_and_release_parts(manifest_path, out_path, partitions)
+            # every record of the partitions now points into out_path, so their merged files are no longer needed
+            for i in range(args.num_partitions):
+                partition_path = get_partition_path(out_path, i, args.num_partitions)
+                if os.path.exists(partition_path):
+                    os.remove(partition_path)
+        sys.exit()
+
     filepaths = sorted(list(glob.glob("data/raw/s2orc/*")))
     print(f"Total number of filepaths: {len(filepaths)}")
 
-    out_path = "data/extracted/papers.jsonl"
-    print(f"Writing to {out_path}")
-    with open(out_path, "w") as f_out:
-        for i, filepath in enumerate(filepaths):
-            print(f"Filepath {i}: {filepath}")
-            with open(filepath, "r") as f, Pool(10) as p:
-                for result in p.imap(process_line, tqdm(f.readlines())):
-                    if result is not None:
-                        print(json.dumps(result), file=f_out, flush=True)
\ No newline at end of file
+    # the units of work are whole shards in stream mode and byte ranges in ranges mode. they are split over
+    # partitions by size, and each unit keeps its index within its shard, so that part names do not depend on
+    # the partitioning
+    if args.mode == "ranges":
+        units = [
+            (i, *byte_range)
+            for filepath in filepaths
+            for i, byte_range in enumerate(split_byte_ranges(filepath, args.range_size))
+        ]
+    else:
+        units = [(0, filepath, 0, os.path.getsize(filepath)) for filepath in filepaths]
+    units = select_partition(
+        units, [end - start for _, _, start, end in units], args.num_partitions, args.partition_index,
+    )
+    filepaths = sorted(set(filepath for _, filepath, _, _ in units))
+    if args.num_partitions > 1:
+        print(f"Partition {args.partition_index} of {args.num_partitions}: "
+              f"{len(units)} units from {len(filepaths)} filepaths")
+
+    metadata_lookup_dir = args.metadata_lookup_dir
+    if not os.path.exists(metadata_lookup_dir):
+        print(f"No metadata lookup found at {metadata_lookup_dir}, so titles and years will be left empty")
+        metadata_lookup_dir = None
+
+    # every node writes its own outputs (and keeps its own checkpoints), next to those of the other partitions
+    out_path = get_partition_path(out_path, args.partition_index, args.num_partitions)
+
+    # every shard is written to its own parts, and gets a completion record once all of them are written. shards
+    # whose record matches the current fingerprint of the shard and the units assigned to this partition are skipped;
+    # missing or changed shards are redone
+    store = CheckpointStore(get_checkpoint_dir(out_path))
+    filepath2units = {}
+    for _, filepath, start, end in units:
+        filepath2units.setdefault(filepath, []).append((filepath, start, end))
+    fingerprints, merged_fingerprints = {}, {}
+    todo_filepaths = set()
+    for filepath in filepaths:
+        shard = os.path.basename(filepath)
+        fingerprints[shard] = get_fingerprint(filepath)
+        if is_shard_done(store, shard, fingerprints[shard], filepath2units[filepath], merged_fingerprints):
+            continue
+        remove_shard_record(store, shard)
+        todo_filepaths.add(filepath)
+    print(f"Number of shards to (re)build: {len(todo_filepaths)} (skipping {len(filepaths) - len(todo_filepaths)})")
+    todo_units = [unit for unit in units if unit[1] in todo_filepaths]
+
+    metrics = BuildMetrics(
+        out_path, "build_papers", num_workers, 
+        labels = {"partition": f"{args.partition_index}-of-{args.num_partitions}"} if args.num_partitions > 1 else None,
+        metrics_dir = args.metrics_dir, 
+        interval_seconds = args.metrics_interval,
+    )
+    for filepath in filepaths:
+        if filepath not in todo_filepaths:
+            record = store.load(os.path.basename(filepath))
+            metrics.finish_shard(
+                os.path.basename(filepath), status="skipped", seconds=0., 
+                num_lines=record["num_lines"], num_papers=record["num_papers"],
+            )
+    metrics.set_backlog(len(todo_units))
+    metrics.write()
+
+    aggregator = None if args.profile_top_n is None else ProfileAggregator(args.profile_top_n)
+
+    # a single pool lives for the whole run, so that workers are only started (and import the schemas) once
+    with Pool(num_workers, initializer=init_worker, initargs=(metadata_lookup_dir,)) as p:
+        if args.mode == "ranges":
+            # each byte range is written to its own part, numbered within its shard in input order
+            tasks = [
+                (get_part_path(out_path, i, shard=os.path.basename(filepath)), filepath, start, end)
+                for i, filepath, start, end in todo_units
+            ]
+            print(f"Total number of byte ranges: {len(tasks)}")
+            num_tasks_per_shard = Counter(os.path.basename(filepath) for _, filepath, _, _ in tasks)
+
+            # imap returns parts in task order, so a shard is complete once its last range comes back
+            shard_parts = []
+            process_task = partial(
+                process_byte_range, validate_fraction=args.validate_fraction, profile_top_n=args.profile_top_n,
+            )
+            with tqdm(total=sum(end - start for _, _, start, end in tasks), unit="B", unit_scale=True) as pbar:
+                for num_done, part in enumerate(p.imap(process_task, tasks), start=1):
+                    if aggregator is not None:
+                        aggregator.merge(part.pop("profile"))
+                    shard_parts.append(part)
+                    pbar.update(part["end"] - part["start"])
+                    metrics.add(
+                        lines=part["num_lines"], papers=part["num_papers"], 
+                        failures=part["num_lines"] - part["num_papers"], 
+                        input_bytes=part["end"] - part["start"], output_bytes=os.path.getsize(part["path"]),
+                    )
+                    metrics.add_busy_seconds(part["seconds"])
+                    metrics.set_backlog(len(tasks) - num_done)
+
+                    # the time of a shard is the worker time of its byte ranges, which may overlap
+                    shard = os.path.basename(part["filepath"])
+                    if len(shard_parts) == num_tasks_per_shard[shard]:
+                        record = get_shard_record(fingerprints[shard], shard_parts)
+                        store.save(shard, record)
+                        metrics.finish_shard(
+                            shard, seconds=sum(part["seconds"] for part in shard_parts), 
+                            num_lines=record["num_lines"], num_papers=record["num_papers"],
+                        )
+                        shard_parts = []
+                    metrics.maybe_write()
+
+        else:
+            max_in_flight = MAX_IN_FLIGHT_PER_WORKER * num_workers
+            for i, filepath in enumerate(sorted(todo_filepaths)):
+                print(f"Filepath {i}: {filepath}")
+                shard = os.path.basename(filepath)
+                metrics.start_shard(shard)
+                part = process_shard_stream(
+                    p, get_part_path(out_path, 0, shard=shard), filepath, 
+                    args.batch_size, args.queue_size, max_in_flight, args.validate_fraction, aggregator, metrics,
+                )
+                store.save(shard, get_shard_record(fingerprints[shard], [part]))
+                metrics.add(input_bytes=part["end"])
+                metrics.set_backlog(len(todo_filepaths) - i - 1)
+                metrics.finish_shard(shard, num_lines=part["num_lines"], num_papers=part["num_papers"])
+
+    # the manifest lists the parts of every shard in input order, whether they were written by this run or not
+    records = [store.load(os.path.basename(filepath)) for filepath in filepaths]
+    manifest_path = get_manifest_path(out_path)
+    print(f"Writing manifest to {manifest_path}")
+    write_manifest(manifest_path, [part for record in records for part in record["parts"]])
+    print(f"Number of papers: {sum(record['num_papers'] for record in records)} "
+          f"(from {sum(record['num_lines'] for record in records)} lines)")
+
+    if (args.merge or args.mode == "stream") and (todo_filepaths or not is_merged(records, out_path)):
+        print(f"Merging parts into {out_path}")
+        merge_and_release_parts(manifest_path, out_path, [(store, manifest_path)])
+
+    metrics.finish()
+    print(f"Metrics written to {metrics.prom_path} and {metrics.json_path}")
+
+    if aggregator is not None:
+        print(aggregator.report())
@@ -0,0 +1,21 @@
+import argparse
+
+from s2ag_parser.pool_utils import get_num_workers
+from s2ag_parser.text_index_utils import DEFAULT_INDEX_RANGE_SIZE, TextIndex, build_text_index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-paths", nargs="+", default=["data/extracted/papers.jsonl"],
+        help="papers.jsonl files (or part files) to index, in order")
+    parser.add_argument("--out-dir", default="data/extracted/text_index",
+        help="Directory to write the index to")
+    parser.add_argument("--num-workers", type=int, default=None,
+        help="Number of worker processes (default: os.cpu_count())")
+    parser.add_argument("--range-size", type=int, default=DEFAULT_INDEX_RANGE_SIZE,
+        help="Bytes of input indexed by a worker at a time, which bounds its memory")
+    args = parser.parse_args()
+
+    print(f"Writing the paragraph index to {args.out_dir}")
+    build_text_index(args.input_paths, args.out_dir, get_num_workers(args.num_workers), args.range_size)
+    with TextIndex(args.out_dir) as index:
+        print(f"{len(index)} paragraphs, {index.meta['num_terms']} terms, {index.meta['num_tokens']} tokens")
@@ -0,0 +1,75 @@
+import argparse
+from importlib import import_module
+from itertools import islice
+import sys
+
+from s2ag_parser.io_utils import encode_json_line
+from s2ag_parser.pool_utils import get_num_workers
+from s2ag_parser.scan_utils import DEFAULT_SCAN_RANGE_SIZE, PROJECTIONS, build_query, scan
+
+def load_function(spec: str):
+    # e.g. "my_package.filters:is_long" -> my_package.filters.is_long. the function must be importable by the
+    # workers, so it cannot be defined in __main__
+    module_name, _, fn_name = spec.partition(":")
+    return getattr(import_module(module_name), fn_name)
+
+def read_corpusids_arg(values: list[str]) -> list[int]:
+    # corpusids given directly, or @path for a file with one corpusid per line
+    corpusids = []
+    for value in values:
+        if value.startswith("@"):
+            with open(value[1:], "r") as f:
+                corpusids.extend(int(line) for line in f if line.strip())
+        else:
+            corpusids.append(int(value))
+    return corpusids
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-paths", nargs="+", default=["data/extracted/papers.jsonl"],
+        help="jsonl files to scan; a *.manifest.json stands for its parts")
+    parser.add_argument("--corpusids", nargs="+", default=None,
+        help="only scan these corpusids (or @file with one per line); uses the offset index if there is one")
+    parser.add_argument("--has-content-type", nargs="+", default=[],
+        help="only keep papers with contents of all of these types, e.g. table")
+    parser.add_argument("--cites", nargs="+", type=int, default=[],
+        help="only keep papers whose bibliography links to all of these corpusids")
+    parser.add_argument("--contains", nargs="+", default=[],
+        help="only keep papers with a paragraph that contains each of these strings")
+    parser.add_argument("--predicate", type=str, default=None,
+        help="module:function taking a paper dict and returning whether to keep it")
+    parser.add_argument("--projection", type=str, default="full",
+        help=f"one of {', '.join(PROJECTIONS)}, or module:function taking a paper dict and returning what to write")
+    parser.add_argument("--out-path", type=str, default=None, help="jsonl file to write matches to (default: stdout)")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--range-size", type=int, default=DEFAULT_SCAN_RANGE_SIZE,
+        help="bytes of input per task")
+    parser.add_argument("--limit", type=int, default=None, help="stop after this many matches")
+    args = parser.parse_args()
+
+    query = build_query(
+        corpusids = None if args.corpusids is None else read_corpusids_arg(args.corpusids),
+        content_types = args.has_content_type,
+        cited_corpusids = args.cites,
+        texts = args.contains,
+        predicate = None if args.predicate is None else load_function(args.predicate),
+        projection = PROJECTIONS[args.projection] if args.projection in PROJECTIONS else load_function(args.projection),
+    )
+
+    counts = {}
+    f = sys.stdout.buffer if args.out_path is None else open(args.out_path, "wb")
+    # closing the scan as soon as --limit is reached stops its workers
+    results = scan(args.input_paths, query, get_num_workers(args.num_workers), args.range_size, counts)
+    try:
+        for result in islice(results, args.limit):
+            # full papers come back as their raw lines, which are written as they are
+            f.write(result if query.projection is None else encode_json_line(result))
+    finally:
+        results.close()
+        if f is not sys.stdout.buffer:
+            f.close()
+
+    print(
+        f"{counts['num_matches']} matches; decoded {counts['num_decoded']} of {counts['num_lines']} scanned lines",
+        file=sys.stderr,
+    )
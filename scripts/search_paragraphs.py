@@ -0,0 +1,42 @@
+import argparse
+import json
+import os
+
+from s2ag_parser.datautils import get_content, get_text
+from s2ag_parser.index_utils import OffsetIndexReader, get_index_paths
+from s2ag_parser.text_index_utils import TextIndex
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("query", type=str)
+    parser.add_argument("--index-dir", default="data/extracted/text_index",
+        help="Directory of the index written by build_text_index.py")
+    parser.add_argument("--mode", choices=["and", "phrase", "bm25"], default="bm25",
+        help="and: paragraphs with every term, phrase: paragraphs with the exact phrase, bm25: the top paragraphs by "
+            "BM25 score")
+    parser.add_argument("--top-k", type=int, default=10,
+        help="Number of paragraphs to print (all matches if negative)")
+    parser.add_argument("--papers-path", type=str, default=None,
+        help="Also print the text of each paragraph, looked up in this papers.jsonl (which needs an offset index, "
+            "see build_index.py)")
+    args = parser.parse_args()
+
+    with TextIndex(args.index_dir) as index:
+        if args.mode == "bm25":
+            docs, scores = index.search_bm25(args.query, len(index) if args.top_k < 0 else args.top_k)
+        else:
+            docs = index.search_and(args.query) if args.mode == "and" else index.search_phrase(args.query)
+            docs, scores = (docs if args.top_k < 0 else docs[:args.top_k]), None
+        results = index.get_docs(docs)
+
+    if scores is not None:
+        for result, score in zip(results, scores):
+            result["score"] = float(score)
+    if args.papers_path is not None:
+        assert os.path.exists(get_index_paths(args.papers_path)[0]), f"{args.papers_path} has no offset index"
+        with OffsetIndexReader(args.papers_path) as reader:
+            for result in results:
+                result["text"] = get_text(get_content(reader.get(result["corpusid"]), result["content_id"]))
+
+    for result in results:
+        print(json.dumps(result))